@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# Benchmark / prueba de carga offline del bot.
+#
+# Ejecuta los handlers reales (agregar, editar, eliminar, listar) con Updates sintéticos
+# contra un Bot API falso en proceso, un ImgBB falso por HTTP local y un repo git bare
+# local como remoto de publicación (o, con --backend api, un GitHub falso en memoria
+# detrás de httpx.MockTransport). No necesita red ni credenciales.
+#
+#   python bench_bot.py                                   # 100, 1000, 10000 y 50000 productos
+#   python bench_bot.py --productos 1000 --backend api    # publicando por la API de GitHub
+#   python bench_bot.py --productos 1000 --concurrencia 16 --operaciones 50
+#   python bench_bot.py --productos 5000 --json           # salida para comparar entre versiones
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TAMANOS = [100, 1000, 10000, 50000]
+TOKEN = "123456:bench"
+MEZCLA = {"agregar": 0.4, "editar": 0.3, "eliminar": 0.1, "listar": 0.2}
+PALABRAS = ["air", "max", "runner", "classic", "urban", "sport", "retro", "pro", "lite", "street", "hoodie", "polo", "jogger", "chaqueta", "camiseta"]
+
+def percentil(muestras, q):
+    if not muestras:
+        return 0.0
+    orden = sorted(muestras)
+    return orden[min(len(orden) - 1, int(q * len(orden)))]
+
+def tamano_dir(ruta):
+    return sum(f.stat().st_size for f in Path(ruta).rglob("*") if f.is_file())
+
+def git(ruta, *args):
+    subprocess.run(["git", "-C", str(ruta), *args], capture_output=True, check=True)
+
+# ── ImgBB falso ──
+
+class ImgBBFalso(BaseHTTPRequestHandler):
+    latencia = 0.0
+    subidas = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latencia)
+        ImgBBFalso.subidas += 1
+        cuerpo = json.dumps({"success": True, "data": {"display_url": f"http://127.0.0.1/i/{ImgBBFalso.subidas}.jpg"}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+def iniciar_imgbb(latencia):
+    ImgBBFalso.latencia = latencia
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), ImgBBFalso)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+def imagen_prueba():
+    try:
+        from PIL import Image
+        import io
+        img = Image.effect_noise((1200, 900), 64).convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        return buf.getvalue()
+    except ImportError:
+        return os.urandom(200_000)
+
+# ── Catálogo y remoto ──
+
+def generar_catalogo(n):
+    rnd = random.Random(n)
+    productos = []
+    for i in range(n):
+        nombre = " ".join(rnd.choice(PALABRAS) for _ in range(3)).title()
+        productos.append({
+            "id": f"producto_bench_{i}",
+            "nombre": nombre,
+            "precio": str(rnd.randrange(20, 900) * 1000),
+            "descripcion": f"{nombre} edición {i}",
+            "tallas": "38-44",
+            "categoria": "zapatillas" if i % 2 else "ropa",
+            "imagen": f"https://i.ibb.co/bench/{i}.jpg",
+            "imagenes": [],
+            "videos": [],
+            "fecha": f"2024-01-01T00:00:{i % 60:02d}+00:00",
+            "agregado_por": "bench",
+        })
+    return productos
+
+def preparar_remoto(tb, dir_base, productos):
+    remoto = dir_base / "remoto.git"
+    semilla = dir_base / "semilla"
+    subprocess.run(["git", "init", "--bare", "-b", "main", str(remoto)], capture_output=True, check=True)
+    subprocess.run(["git", "init", "-b", "main", str(semilla)], capture_output=True, check=True)
+    for ruta, contenido in tb.generar_archivos(productos).items():
+        destino = semilla / ruta
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        destino.write_bytes(contenido)
+    git(semilla, "add", "-A")
+    git(semilla, "-c", "user.email=bench@local", "-c", "user.name=bench", "commit", "-m", "seed")
+    git(semilla, "push", str(remoto), "HEAD:main")
+    return remoto
+
+# ── GitHub falso ──
+
+class GitHubFalso:
+    # Lo que usa GitHubAPIBackend de la API de GitHub (contents, git/ref, trees, commits, blobs)
+    # sobre un repo en memoria. Los SHA de blob son los de git: el bot los compara con los suyos.
+    def __init__(self, tb, productos, rama="main"):
+        self.tb = tb
+        self.rama = rama
+        self.blobs, self.trees, self.commits = {}, {}, {}
+        self.llamadas = 0
+        self.head = self.commit(self.tree({}, tb.generar_archivos(productos)), [])
+
+    def guardar(self, tipo, dato):
+        sha = hashlib.sha1(f"{tipo}:{json.dumps(dato, sort_keys=True)}".encode()).hexdigest()
+        (self.trees if tipo == "tree" else self.commits)[sha] = dato
+        return sha
+
+    def tree(self, base, archivos):
+        entradas = dict(base)
+        for ruta, contenido in archivos.items():
+            if contenido is None:
+                entradas.pop(ruta, None)
+                continue
+            sha = self.tb.git_blob_sha(contenido)
+            self.blobs[sha] = contenido
+            entradas[ruta] = sha
+        return self.guardar("tree", entradas)
+
+    def commit(self, tree, padres):
+        return self.guardar("commit", {"tree": tree, "parents": padres})
+
+    def bytes(self):
+        return sum(len(b) for b in self.blobs.values())
+
+    def responder(self, request):
+        import httpx
+        self.llamadas += 1
+        ruta = request.url.path.split("/", 4)[4]
+        cuerpo = json.loads(request.content) if request.content else {}
+        archivos = self.trees[self.commits[self.head]["tree"]]
+        if request.method == "GET" and ruta == f"git/ref/heads/{self.rama}":
+            return httpx.Response(200, json={"object": {"sha": self.head}})
+        if request.method == "GET" and ruta.startswith("git/trees/"):
+            tree = self.trees[self.commits[ruta[10:]]["tree"]]
+            return httpx.Response(200, json={"tree": [{"path": r, "type": "blob", "sha": sha} for r, sha in tree.items()]})
+        if request.method == "GET" and ruta.startswith("contents/"):
+            sha = archivos.get(ruta[9:])
+            if sha is None:
+                return httpx.Response(404, json={"message": "Not Found"})
+            return httpx.Response(200, json={"sha": sha, "encoding": "base64", "content": base64.b64encode(self.blobs[sha]).decode()})
+        if request.method == "GET" and ruta.startswith("git/blobs/"):
+            return httpx.Response(200, json={"content": base64.b64encode(self.blobs[ruta[10:]]).decode()})
+        if request.method == "GET" and ruta.startswith("git/commits/"):
+            return httpx.Response(200, json={"tree": {"sha": self.commits[ruta[12:]]["tree"]}})
+        if request.method == "POST" and ruta == "git/trees":
+            nuevos = {e["path"]: (e["content"].encode() if e.get("sha", "") is not None else None) for e in cuerpo["tree"]}
+            return httpx.Response(201, json={"sha": self.tree(self.trees[cuerpo["base_tree"]], nuevos)})
+        if request.method == "POST" and ruta == "git/commits":
+            return httpx.Response(201, json={"sha": self.commit(cuerpo["tree"], cuerpo["parents"])})
+        if request.method == "PATCH" and ruta == f"git/refs/heads/{self.rama}":
+            if self.commits[cuerpo["sha"]]["parents"] != [self.head]:
+                return httpx.Response(422, json={"message": "Update is not a fast forward"})
+            self.head = cuerpo["sha"]
+            return httpx.Response(200, json={"object": {"sha": self.head}})
+        return httpx.Response(404, json={"message": f"no simulado: {request.method} {ruta}"})
+
+    def conectar(self, backend):
+        import httpx
+        backend.client = httpx.AsyncClient(base_url=backend.base_url, transport=httpx.MockTransport(self.responder),
+                                           event_hooks={"request": [self.tb.inicio_peticion], "response": [self.tb.fin_peticion]})
+
+# ── Telegram falso ──
+
+def crear_request_falso(imagen, latencia):
+    from telegram.request import BaseRequest
+
+    class TelegramFalso(BaseRequest):
+        # Responde en proceso a las llamadas del Bot API y a las descargas de archivos.
+        def __init__(self):
+            self.llamadas = {}
+            self.mensaje = 0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            if latencia:
+                await asyncio.sleep(latencia)
+            if "/file/bot" in url:
+                # Bytes distintos por file_id (basura tras el EOI del JPEG): solo las fotos repetidas coinciden.
+                return 200, imagen + url.rsplit("/", 1)[-1].encode()
+            metodo = url.rsplit("/", 1)[-1]
+            self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+            params = request_data.parameters if request_data else {}
+            if metodo == "getMe":
+                resultado = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif metodo == "getFile":
+                resultado = {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"), "file_size": len(imagen), "file_path": f"photos/{params.get('file_id')}.jpg"}
+            elif metodo in ("sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument"):
+                self.mensaje += 1
+                resultado = {"message_id": self.mensaje, "date": int(time.time()), "chat": {"id": int(params.get("chat_id") or 1), "type": "private"}, "text": params.get("text", "")}
+            else:
+                resultado = True
+            return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+    return TelegramFalso()
+
+class Admin:
+    # Un admin sintético: genera los Updates de cada flujo con su propio chat.
+    def __init__(self, uid, tg):
+        self.uid = uid
+        self.tg = tg
+        self.usuario = {"id": uid, "is_bot": False, "first_name": f"admin{uid}"}
+        self.chat = {"id": uid, "type": "private"}
+        self.n = 0
+
+    def base(self):
+        self.n += 1
+        return {"update_id": self.uid * 1_000_000 + self.n}
+
+    def mensaje(self, **campos):
+        return dict(self.base(), message=dict({"message_id": self.n, "date": int(time.time()), "chat": self.chat, "from": self.usuario}, **campos))
+
+    def texto(self, texto):
+        if texto.startswith("/"):
+            return self.mensaje(text=texto, entities=[{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}])
+        return self.mensaje(text=texto)
+
+    def foto(self, repetida=False):
+        fid = "foto_repetida" if repetida else f"foto_{self.uid}_{self.n}"
+        return self.mensaje(photo=[{"file_id": fid, "file_unique_id": fid, "width": 1200, "height": 900}])
+
+    def boton(self, data):
+        return dict(self.base(), callback_query={"id": str(self.n), "from": self.usuario, "chat_instance": str(self.uid), "data": data,
+                                                 "message": {"message_id": self.n, "date": int(time.time()), "chat": self.chat}})
+
+async def correr_flujo(admin, pasos, latencias):
+    from telegram import Update
+    for paso, datos in pasos:
+        t = time.perf_counter()
+        await admin.tg.process_update(Update.de_json(datos, admin.tg.bot))
+        latencias.setdefault(paso, []).append(time.perf_counter() - t)
+
+def flujo(tb, admin, operacion, rnd, args):
+    ids = list(tb.store.productos)
+    if operacion == "agregar":
+        nombre = " ".join(rnd.choice(PALABRAS) for _ in range(3))
+        return [("agregar", admin.texto("/agregar")), ("nombre", admin.texto(nombre)), ("precio", admin.texto(str(rnd.randrange(20, 900) * 1000))),
+                ("descripcion", admin.texto(f"{nombre} bench")), ("tallas", admin.texto("38-44")), ("categoria", admin.boton("cat_zapatillas")),
+                ("foto", admin.foto(rnd.random() < args.fotos_repetidas)), ("finalizar", admin.boton("finalizar_medios"))]
+    if operacion == "editar" and ids:
+        return [("editar", admin.texto("/editar")), ("editar_producto", admin.boton(f"edit_{rnd.choice(ids)}")), ("editar_campo", admin.boton("ef_precio")),
+                ("editar_guardar", admin.texto(str(rnd.randrange(20, 900) * 1000)))]
+    if operacion == "eliminar" and ids:
+        pid = rnd.choice(ids)
+        return [("eliminar", admin.texto("/eliminar")), ("eliminar_producto", admin.boton(f"del_{pid}")), ("eliminar_confirmar", admin.boton(f"del_confirm_{pid}"))]
+    return [("listar", admin.texto("/listar"))]
+
+async def cargar(tb, tg, args):
+    rnd = random.Random(args.semilla)
+    latencias = {}
+    por_operacion = {}
+    guardados = 0
+    operaciones = list(MEZCLA)
+    pesos = [MEZCLA[o] for o in operaciones]
+
+    async def trabajador(uid):
+        nonlocal guardados
+        admin = Admin(uid, tg)
+        for _ in range(args.operaciones):
+            operacion = rnd.choices(operaciones, pesos)[0]
+            t = time.perf_counter()
+            await correr_flujo(admin, flujo(tb, admin, operacion, rnd, args), latencias)
+            por_operacion.setdefault(operacion, []).append(time.perf_counter() - t)
+            if operacion != "listar":
+                guardados += 1
+
+    t = time.perf_counter()
+    await asyncio.gather(*[trabajador(uid) for uid in range(1, args.concurrencia + 1)])
+    carga = time.perf_counter() - t
+    return latencias, por_operacion, guardados, carga
+
+async def correr(n, args):
+    dir_base = Path(tempfile.mkdtemp(prefix=f"bench_{n}_"))
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "ADMIN_IDS": ",".join(str(uid) for uid in range(1, args.concurrencia + 1)),
+        "IMGBB_API_KEY": "bench",
+        "PUBLISH_BACKEND": args.backend,
+        "GITHUB_USER": "bench",
+        "GITHUB_REPO": "catalogo",
+        "GITHUB_TOKEN": "bench",
+        "PUBLISH_DEBOUNCE_SECONDS": str(args.debounce),
+        "LOCAL_REPO_PATH": str(dir_base / "trabajo"),
+        "JOURNAL_PATH": str(dir_base / "catalogo.journal"),
+        "SNAPSHOT_PATH": str(dir_base / "catalogo.snapshot.json"),
+        "IMAGE_DERIVATIVES": "1" if args.derivados else "0",
+        "IMAGE_CACHE_PATH": str(dir_base / "catalogo.imagenes.json"),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+    imgbb = iniciar_imgbb(args.latencia_imgbb / 1000)
+    os.environ["IMGBB_API_URL"] = f"http://127.0.0.1:{imgbb.server_address[1]}/upload"
+    os.environ["GIT_REMOTE_URL"] = str(dir_base / "remoto.git")
+    import telegram_bot as tb
+    import metricas
+
+    if args.backend == "api":
+        github = GitHubFalso(tb, generar_catalogo(n))
+        github.conectar(tb.backend)
+        medir_remoto = github.bytes
+    else:
+        remoto = preparar_remoto(tb, dir_base, generar_catalogo(n))
+        medir_remoto = lambda: tamano_dir(remoto)
+    bytes_remoto = medir_remoto()
+
+    falso = crear_request_falso(imagen_prueba(), args.latencia_telegram / 1000)
+    tg = tb.construir_aplicacion(con_updater=False, request=falso)
+    await tg.initialize()
+    t = time.perf_counter()
+    await tb.iniciar_publicador(tg)
+    arranque = time.perf_counter() - t
+
+    latencias, por_operacion, guardados, carga = await cargar(tb, tg, args)
+    t = time.perf_counter()
+    await tb.detener_publicador(tg)
+    vaciado = time.perf_counter() - t
+    await tg.shutdown()
+    imgbb.shutdown()
+    bytes_publicados_remoto = medir_remoto() - bytes_remoto
+    if not args.conservar:
+        shutil.rmtree(dir_base, ignore_errors=True)
+
+    publicar = [(e, h) for (nombre, e), h in metricas.histogramas.items() if nombre == "publicar_segundos"]
+    contadores = {nombre + metricas.formato_etiquetas(e): v for (nombre, e), v in metricas.contadores.items()}
+    return {
+        "productos": n,
+        "productos_final": len(tb.store),
+        "concurrencia": args.concurrencia,
+        "backend": args.backend,
+        "arranque_s": arranque,
+        "carga_s": carga,
+        "vaciado_s": vaciado,
+        "guardados": guardados,
+        "guardados_por_s": guardados / carga if carga else 0.0,
+        "publicaciones": sum(h["total"] for _, h in publicar),
+        "publicar_promedio_s": sum(h["suma"] for _, h in publicar) / max(1, sum(h["total"] for _, h in publicar)),
+        "bytes_publicados": contadores.get("bytes_publicados", 0),
+        "bytes_remoto": bytes_publicados_remoto,
+        "subidas_imgbb": ImgBBFalso.subidas,
+        "cache_imagenes": {dict(e)["resultado"]: v for (nombre, e), v in metricas.contadores.items() if nombre == "cache_imagenes"},
+        "llamadas_telegram": falso.llamadas,
+        "operaciones": {op: {"n": len(m), "p50_ms": percentil(m, 0.5) * 1000, "p99_ms": percentil(m, 0.99) * 1000} for op, m in por_operacion.items()},
+        "pasos": {paso: {"n": len(m), "p50_ms": percentil(m, 0.5) * 1000, "p99_ms": percentil(m, 0.99) * 1000} for paso, m in latencias.items()},
+        "directorio": str(dir_base) if args.conservar else None,
+    }
+
+def imprimir(r):
+    print(f"\n📦 {r['productos']} productos → {r['productos_final']} | backend {r['backend']} | concurrencia {r['concurrencia']} | arranque {r['arranque_s']:.2f}s")
+    print(f"   {'operación':<20}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}")
+    for nombre, m in list(r["operaciones"].items()) + [("", None)] + list(r["pasos"].items()):
+        if m is None:
+            print("   " + "─" * 46)
+            continue
+        print(f"   {nombre:<20}{m['n']:>6}{m['p50_ms']:>10.1f}{m['p99_ms']:>10.1f}")
+    print(f"   💾 {r['guardados']} guardados en {r['carga_s']:.2f}s → {r['guardados_por_s']:.1f}/s (vaciado final {r['vaciado_s']:.2f}s)")
+    print(f"   🖼️ {r['subidas_imgbb']} subidas a ImgBB | cache de imágenes: {r['cache_imagenes']}")
+    print(f"   🌐 {r['publicaciones']} publicaciones (promedio {r['publicar_promedio_s']:.2f}s) | {r['bytes_publicados']:,} bytes publicados | +{r['bytes_remoto']:,} bytes en el remoto")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del bot del catálogo")
+    parser.add_argument("--productos", default=",".join(map(str, TAMANOS)), help="tamaños del catálogo, separados por coma")
+    parser.add_argument("--concurrencia", type=int, default=8, help="admins simultáneos")
+    parser.add_argument("--operaciones", type=int, default=25, help="operaciones por admin")
+    parser.add_argument("--debounce", type=float, default=0.5, help="PUBLISH_DEBOUNCE_SECONDS durante la prueba")
+    parser.add_argument("--latencia-imgbb", type=float, default=50, help="ms por subida al ImgBB falso")
+    parser.add_argument("--latencia-telegram", type=float, default=0, help="ms por llamada al Bot API falso")
+    parser.add_argument("--fotos-repetidas", type=float, default=0.3, help="fracción de fotos que reenvían la misma imagen")
+    parser.add_argument("--sin-derivados", dest="derivados", action="store_false", help="no generar miniaturas WebP")
+    parser.add_argument("--backend", choices=["git", "api"], default="git", help="git: repo bare local; api: GitHub falso con httpx.MockTransport")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--conservar", action="store_true", help="no borrar el directorio temporal (repo bare, journal, snapshot)")
+    parser.add_argument("--json", action="store_true", help="imprimir resultados en JSON")
+    args = parser.parse_args()
+
+    tamanos = [int(x) for x in args.productos.split(",") if x.strip()]
+    if len(tamanos) == 1:
+        resultado = asyncio.run(correr(tamanos[0], args))
+        if args.json:
+            print(json.dumps(resultado))
+        else:
+            imprimir(resultado)
+        return
+    # Un proceso por tamaño: el módulo del bot guarda el estado (store, journal, publicador) a nivel global.
+    resultados = []
+    for n in tamanos:
+        cmd = [sys.executable, __file__, "--productos", str(n), "--json", "--concurrencia", str(args.concurrencia), "--operaciones", str(args.operaciones),
+               "--debounce", str(args.debounce), "--latencia-imgbb", str(args.latencia_imgbb), "--latencia-telegram", str(args.latencia_telegram), "--semilla", str(args.semilla), "--backend", args.backend,
+               "--fotos-repetidas", str(args.fotos_repetidas)]
+        cmd += ["--sin-derivados"] * (not args.derivados) + ["--conservar"] * args.conservar
+        salida = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        resultados.append(json.loads(salida.strip().splitlines()[-1]))
+        if not args.json:
+            imprimir(resultados[-1])
+    if args.json:
+        print(json.dumps(resultados))
+
+if __name__ == "__main__":
+    main()
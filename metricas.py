@@ -0,0 +1,160 @@
+import sys
+import json
+import time
+import logging
+import functools
+import contextvars
+from datetime import datetime, timezone
+
+# Métricas en memoria del bot: histogramas de latencia, contadores y medidores,
+# exportados en formato texto de Prometheus (/metrics) y resumidos en /stats.
+# También los logs estructurados (una línea JSON por evento, con el id del update).
+
+PREFIJO = "catalogo_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+correlacion = contextvars.ContextVar("correlacion", default=None)
+
+histogramas = {}
+contadores = {}
+medidores = {}
+
+def clave(nombre, etiquetas):
+    return (nombre, tuple(sorted(etiquetas.items())))
+
+def observar(nombre, segundos, **etiquetas):
+    h = histogramas.get(clave(nombre, etiquetas))
+    if h is None:
+        h = histogramas[clave(nombre, etiquetas)] = {"buckets": [0] * len(BUCKETS), "suma": 0.0, "total": 0}
+    for i, limite in enumerate(BUCKETS):
+        if segundos <= limite:
+            h["buckets"][i] += 1
+            break
+    h["suma"] += segundos
+    h["total"] += 1
+
+def contar(nombre, n=1, **etiquetas):
+    k = clave(nombre, etiquetas)
+    contadores[k] = contadores.get(k, 0) + n
+
+def medidor(nombre, fn, **etiquetas):
+    # fn se evalúa al exportar (tamaño del catálogo, colas, etc).
+    medidores[clave(nombre, etiquetas)] = fn
+
+class medir:
+    # with medir("imgbb_segundos"): ... — sirve igual dentro de corutinas.
+    def __init__(self, nombre, **etiquetas):
+        self.nombre = nombre
+        self.etiquetas = etiquetas
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        etiquetas = dict(self.etiquetas, resultado="error" if tipo else "ok")
+        observar(self.nombre, time.perf_counter() - self.inicio, **etiquetas)
+        return False
+
+def instrumentar(func, nombre=None):
+    nombre = nombre or func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        with medir("handler_segundos", handler=nombre):
+            return await func(update, context)
+    return wrapper
+
+def percentil(h, q):
+    objetivo = q * h["total"]
+    acumulado = 0
+    for limite, n in zip(BUCKETS, h["buckets"]):
+        acumulado += n
+        if acumulado >= objetivo:
+            return limite
+    return float("inf")
+
+def escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def formato_etiquetas(etiquetas, extra=()):
+    pares = list(etiquetas) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in pares) + "}"
+
+def prometheus():
+    lineas = []
+    tipos = set()
+    for (nombre, etiquetas), h in sorted(histogramas.items()):
+        if nombre not in tipos:
+            tipos.add(nombre)
+            lineas.append(f"# TYPE {PREFIJO}{nombre} histogram")
+        acumulado = 0
+        for limite, n in zip(BUCKETS, h["buckets"]):
+            acumulado += n
+            lineas.append(f"{PREFIJO}{nombre}_bucket{formato_etiquetas(etiquetas, [('le', limite)])} {acumulado}")
+        lineas.append(f"{PREFIJO}{nombre}_bucket{formato_etiquetas(etiquetas, [('le', '+Inf')])} {h['total']}")
+        lineas.append(f"{PREFIJO}{nombre}_sum{formato_etiquetas(etiquetas)} {h['suma']:.6f}")
+        lineas.append(f"{PREFIJO}{nombre}_count{formato_etiquetas(etiquetas)} {h['total']}")
+    for (nombre, etiquetas), n in sorted(contadores.items()):
+        if nombre not in tipos:
+            tipos.add(nombre)
+            lineas.append(f"# TYPE {PREFIJO}{nombre} counter")
+        lineas.append(f"{PREFIJO}{nombre}{formato_etiquetas(etiquetas)} {n}")
+    for (nombre, etiquetas), fn in sorted(medidores.items(), key=lambda x: x[0]):
+        try:
+            valor = fn()
+        except Exception:
+            continue
+        if nombre not in tipos:
+            tipos.add(nombre)
+            lineas.append(f"# TYPE {PREFIJO}{nombre} gauge")
+        lineas.append(f"{PREFIJO}{nombre}{formato_etiquetas(etiquetas)} {valor}")
+    return "\n".join(lineas) + "\n"
+
+def resumen():
+    # [(nombre, etiquetas, total, p50, p99, promedio)] ordenado por tiempo total.
+    filas = [(n, dict(e), h["total"], percentil(h, 0.5), percentil(h, 0.99), h["suma"] / h["total"]) for (n, e), h in histogramas.items() if h["total"]]
+    return sorted(filas, key=lambda f: f[2] * f[5], reverse=True)
+
+def valores_medidores():
+    valores = {}
+    for (nombre, etiquetas), fn in medidores.items():
+        try:
+            valores[nombre + formato_etiquetas(etiquetas)] = fn()
+        except Exception:
+            pass
+    return valores
+
+# ── Logs ──
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        data = {"ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(), "nivel": record.levelname.lower(), "evento": record.getMessage()}
+        if correlacion.get() is not None:
+            data["update"] = correlacion.get()
+        data.update(getattr(record, "campos", {}))
+        if record.exc_info:
+            data["traza"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+log = logging.getLogger("catalogo")
+
+def configurar_logs(nivel="INFO"):
+    if log.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FormatoJSON())
+    log.addHandler(handler)
+    log.setLevel(nivel)
+    log.propagate = False
+
+def info(evento, **campos):
+    log.info(evento, extra={"campos": campos})
+
+def aviso(evento, **campos):
+    log.warning(evento, extra={"campos": campos})
+
+def error(evento, **campos):
+    log.error(evento, extra={"campos": campos})
@@ -1,13 +1,48 @@
 #!/usr/bin/env python3
+import time
+T_IMPORT = time.perf_counter()
 import os
 import json
 import subprocess
+import asyncio
 import base64
+import hashlib
+import uuid
+import re
+import io
+import csv
+import bisect
+import unicodedata
+import hmac
+import html
+import contextlib
+import threading
+import multiprocessing
+import shutil
+import tempfile
+import functools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
 from pathlib import Path
+from urllib.parse import quote, urlparse
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ConversationHandler
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ConversationHandler
 import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+import metricas
+from metricas import medir, contar, info, aviso, error
+
+metricas.configurar_logs(os.getenv("LOG_LEVEL", "INFO").upper())
+TIEMPOS_ARRANQUE = {"import": time.perf_counter() - T_IMPORT}
 
 # CONFIGURACIÓN
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -17,132 +52,1878 @@ if ADMIN_IDS_STR:
     try:
         ADMIN_IDS = [int(id.strip()) for id in ADMIN_IDS_STR.split(",") if id.strip()]
     except ValueError:
-        print("Error parseando ADMIN_IDS")
+        error("admin_ids_invalidos", valor=ADMIN_IDS_STR)
 
 GITHUB_USER = os.getenv("GITHUB_USER")
 GITHUB_REPO = os.getenv("GITHUB_REPO")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 IMGBB_API_KEY = os.getenv("IMGBB_API_KEY", "")
+RENDER_URL = os.getenv("RENDER_EXTERNAL_URL")
+# URL pública del servidor ASGI para el webhook; sin ella el bot usa polling.
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or RENDER_URL or "").rstrip("/")
+PORT = int(os.getenv("PORT", 10000))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+# Token para leer /metrics (Authorization: Bearer o ?token=); sin él se usa WEBHOOK_SECRET y sin ninguno /metrics no se sirve.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or WEBHOOK_SECRET
+IMGBB_API_URL = os.getenv("IMGBB_API_URL", "https://api.imgbb.com/1/upload")
+IMGBB_CONCURRENCY = int(os.getenv("IMGBB_CONCURRENCY", "4"))
+IMGBB_RETRIES = int(os.getenv("IMGBB_RETRIES", "3"))
+IMAGE_DERIVATIVES = os.getenv("IMAGE_DERIVATIVES", "1") != "0"
+TAMANOS_DERIVADOS = {"thumb": 320, "medium": 960}
 
 if GITHUB_REPO and "/" in GITHUB_REPO:
     GITHUB_REPO = GITHUB_REPO.split("/")[-1]
 
-print(f"\n🧩 CONFIGURACIÓN:")
-print(f"   BOT_TOKEN: {'✅' if BOT_TOKEN else '❌'}")
-print(f"   ADMIN_IDS: {ADMIN_IDS}")
-print(f"   GITHUB_USER: {GITHUB_USER}")
-print(f"   GITHUB_REPO: {GITHUB_REPO}")
-print(f"   GITHUB_TOKEN: {'✅' if GITHUB_TOKEN else '❌'}")
-print(f"   IMGBB_API_KEY: {'✅' if IMGBB_API_KEY else '⚠️'}\n")
+info("configuracion", bot_token=bool(BOT_TOKEN), admin_ids=ADMIN_IDS, github_user=GITHUB_USER, github_repo=GITHUB_REPO,
+     github_token=bool(GITHUB_TOKEN), imgbb_api_key=bool(IMGBB_API_KEY), publish_backend=os.getenv("PUBLISH_BACKEND", "api"))
 
-LOCAL_REPO_PATH = Path("/tmp/catalogo")
+LOCAL_REPO_PATH = Path(os.getenv("LOCAL_REPO_PATH", "/tmp/catalogo"))
 JSON_FILENAME = "productos.json"
 REPO_BRANCH = "main"
+PUBLISH_DEBOUNCE_SECONDS = float(os.getenv("PUBLISH_DEBOUNCE_SECONDS", "5"))
+PUBLISH_BACKEND = os.getenv("PUBLISH_BACKEND", "api").lower()
+# El journal solo protege algo si sobrevive al reinicio: en producción apuntarlo a un disco persistente.
+JOURNAL_PATH = Path(os.getenv("JOURNAL_PATH", "/tmp/catalogo.journal"))
+# Igual que el journal: en /tmp el arranque rápido solo sirve hasta el próximo redeploy.
+SNAPSHOT_PATH = Path(os.getenv("SNAPSHOT_PATH", "/tmp/catalogo.snapshot.json"))
+IMAGE_CACHE_PATH = Path(os.getenv("IMAGE_CACHE_PATH", "/tmp/catalogo.imagenes.json"))
+IMAGE_CACHE_ENTRIES = int(os.getenv("IMAGE_CACHE_ENTRIES", "10000"))
+# Espera antes de reescribir la cache de imágenes: varias subidas seguidas se guardan de una vez.
+IMAGE_CACHE_SAVE_SECONDS = float(os.getenv("IMAGE_CACHE_SAVE_SECONDS", "30"))
+# Espejo de videos: los links de Telegram caducan (y llevan el token del bot), se copian a MEDIA_DIR
+# y se sirven desde /medios/ (o desde MEDIA_BASE_URL si el directorio se publica por otro lado).
+# Solo se activa con MEDIA_DIR configurado: tiene que ser un disco persistente, o tras un
+# reinicio los productos quedarían apuntando a copias que ya no existen.
+MEDIA_MIRROR = os.getenv("MEDIA_MIRROR", "1") != "0"
+MEDIA_DIR = Path(os.getenv("MEDIA_DIR")) if os.getenv("MEDIA_DIR") else None
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL") or (f"{WEBHOOK_URL}/medios/" if MEDIA_DIR and WEBHOOK_URL else "")
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "2"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(100 * 1024 * 1024)))
+MEDIA_POSTERS = os.getenv("MEDIA_POSTERS", "1") != "0"
+MEDIA_CHECK_INTERVAL = float(os.getenv("MEDIA_CHECK_INTERVAL", "21600"))
+MEDIA_CHECK_CONCURRENCY = int(os.getenv("MEDIA_CHECK_CONCURRENCY", "16"))
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/"
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+CATALOG_LAYOUT = os.getenv("CATALOG_LAYOUT", "single").lower()
+# Remoto git alternativo (p. ej. un repo bare local para bench_bot.py); por defecto GitHub.
+GIT_REMOTE_URL = os.getenv("GIT_REMOTE_URL")
+SHARDS_DIR = "catalogo"
+MANIFEST_FILENAME = f"{SHARDS_DIR}/manifest.json"
+VERSION_FILENAME = "version.json"
+SEARCH_INDEX_FILENAME = "buscar.json"
+PRERENDER = os.getenv("PRERENDER", "1") != "0"
+# Fuente de la página: index.html es salida del bot y se sobrescribe en cada publicación.
+PRERENDER_TEMPLATE = Path(os.getenv("PRERENDER_TEMPLATE", Path(__file__).with_name("plantilla.html")))
+# Tarjetas que van ya pintadas en cada grilla; igual a PAGE_SIZE en la página, el JS agrega el resto.
+PRERENDER_TARJETAS = int(os.getenv("PRERENDER_TARJETAS", "24"))
+PAGINAS_DIR = "p"
+SITE_URL = os.getenv("SITE_URL") or (f"https://{GITHUB_USER}.github.io/{GITHUB_REPO}/" if GITHUB_USER and GITHUB_REPO else "")
 
 NOMBRE, PRECIO, DESCRIPCION, TALLAS, CATEGORIA, IMAGEN, MAS_MEDIOS = range(7)
 EDITAR_CAMPO, EDITAR_VALOR = range(7, 9)
+IMPORTAR_ARCHIVO = 9
+
+CATEGORIAS = ("zapatillas", "ropa")
+CAMPOS_EXPORTAR = ["id", "nombre", "precio", "descripcion", "tallas", "categoria", "imagen", "imagenes", "videos"]
+
+LISTAR_POR_PAGINA = 50
+LISTAR_CARACTERES = 3500
+BOTONES_POR_PAGINA = 20
+
+# ── Modelo ──
+# Esquema 2 de los productos: precio entero en pesos, fechas con zona horaria y, al publicar,
+# sin campos vacíos ni indentación. Los registros del esquema 1 (precio como texto, campos
+# faltantes, fechas sin zona) se migran al leerlos; lo que no es del esquema se conserva en extra.
+# Un precio que no es un número entero de pesos ("A consultar", "12.5") se deja como venía y
+# migrar() lo avisa: nunca se publica en 0 ni redondeado a ciegas.
+
+ESQUEMA = 2
+EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+CAMPOS_PRODUCTO = ("id", "nombre", "precio", "descripcion", "tallas", "categoria", "imagen", "imagenes", "videos", "derivados", "fecha", "modificado", "version", "agregado_por")
+
+# Miles con punto o coma en grupos de 3 (120.000, 1,200,000); lo que sigue a un separador
+# distinto o a un grupo que no es de 3 cifras son decimales (12.5, 1.200,50).
+PATRON_PRECIO = re.compile(r"(\d{1,3}(?:([.,])\d{3})(?:\2\d{3})*|\d+)(?:(?!\2)[.,](\d+))?")
+
+def precio_decimal(texto):
+    if isinstance(texto, (int, float)) and not isinstance(texto, bool):
+        return Decimal(str(texto))
+    m = PATRON_PRECIO.fullmatch(str(texto).strip().replace('$', '').replace(' ', ''))
+    if not m:
+        raise ValueError(f"precio inválido: {texto!r}")
+    return Decimal(re.sub(r"[.,]", "", m.group(1)) + "." + (m.group(3) or "0"))
+
+def parsear_precio(texto):
+    # Entrada del admin: 12.5 -> 13 (mitad hacia arriba, no al par como round()).
+    try:
+        return int(precio_decimal(texto).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except ArithmeticError:
+        raise ValueError(f"precio inválido: {texto!r}")
+
+def a_texto(valor):
+    return "" if valor is None else str(valor)
+
+def a_precio(valor):
+    if valor is None or valor == "":
+        return 0
+    try:
+        decimal = precio_decimal(valor)
+        if decimal == decimal.to_integral_value():
+            return int(decimal)
+    except (ValueError, ArithmeticError):
+        pass
+    return valor
+
+def a_fecha(valor):
+    if not valor:
+        return None
+    if not isinstance(valor, datetime):
+        try:
+            valor = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+def a_entero(valor):
+    try:
+        return int(valor or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def a_lista(valor):
+    if isinstance(valor, str):
+        valor = valor.split("|")
+    return [str(u).strip() for u in valor or [] if u and str(u).strip()]
+
+CONVERSIONES = {campo: a_texto for campo in CAMPOS_PRODUCTO}
+CONVERSIONES.update(precio=a_precio, fecha=a_fecha, modificado=a_fecha, version=a_entero, imagenes=a_lista, videos=a_lista,
+                    derivados=lambda v: dict(v) if isinstance(v, dict) else {}, categoria=lambda v: a_texto(v).strip().lower() or "zapatillas")
+
+class Producto:
+    # __slots__ en vez de un dict por producto. Se sigue usando como dict (p["precio"],
+    # p.get("tallas"), dict(p), {**p}) y cada asignación normaliza el valor al tipo del esquema.
+    __slots__ = CAMPOS_PRODUCTO + ("extra",)
+
+    def __init__(self, **datos):
+        for campo in CAMPOS_PRODUCTO:
+            setattr(self, campo, CONVERSIONES[campo](datos.pop(campo, None)))
+        # Casi nunca hay campos extra: None evita un dict vacío por producto.
+        self.extra = dict(datos) if datos else None
+
+    @classmethod
+    def desde(cls, datos):
+        return datos if isinstance(datos, cls) else cls(**datos)
+
+    def __getitem__(self, campo):
+        if campo in CONVERSIONES:
+            return getattr(self, campo)
+        return (self.extra or {})[campo]
+
+    def __setitem__(self, campo, valor):
+        if campo in CONVERSIONES:
+            setattr(self, campo, CONVERSIONES[campo](valor))
+        else:
+            self.extra = dict(self.extra or {}, **{campo: valor})
+
+    def __contains__(self, campo):
+        return campo in CONVERSIONES or campo in (self.extra or ())
+
+    def get(self, campo, defecto=None):
+        valor = getattr(self, campo) if campo in CONVERSIONES else (self.extra or {}).get(campo)
+        return defecto if valor is None else valor
+
+    def keys(self):
+        return list(CAMPOS_PRODUCTO) + list(self.extra or ())
+
+    def copia(self):
+        otro = Producto.__new__(Producto)
+        for campo in self.__slots__:
+            valor = getattr(self, campo)
+            setattr(otro, campo, valor.copy() if isinstance(valor, (list, dict)) else valor)
+        return otro
+
+    def a_dict(self):
+        # Forma publicada: sin campos vacíos, fechas en ISO 8601.
+        datos = {}
+        for campo in CAMPOS_PRODUCTO:
+            valor = getattr(self, campo)
+            if valor is None or valor == "" or valor == [] or valor == {}:
+                continue
+            datos[campo] = valor.isoformat() if isinstance(valor, datetime) else valor
+        datos.update(self.extra or ())
+        return datos
+
+    def __repr__(self):
+        return f"Producto({self.a_dict()!r})"
+
+def a_json(obj):
+    if isinstance(obj, Producto):
+        return obj.a_dict()
+    raise TypeError(f"{type(obj).__name__} no es serializable")
+
+def migrar(registros):
+    # Esquema 1 -> 2; idempotente sobre registros ya migrados.
+    productos = [Producto.desde(r) for r in registros if isinstance(r, (dict, Producto))]
+    dudosos = {p.id: p.precio for p in productos if not isinstance(p.precio, int)}
+    if dudosos:
+        aviso("precios_sin_migrar", total=len(dudosos), detalle="se dejaron como venían, corrígelos con /editar", ejemplos=dict(list(dudosos.items())[:10]))
+        contar("precios_sin_migrar", len(dudosos))
+    return productos
+
+class ProductStore:
+    # Dueño de los productos. Mantiene de forma incremental un índice por fecha (para
+    # listar por páginas sin reordenar) y buckets por categoría.
+    def __init__(self, productos=()):
+        self.lock = asyncio.Lock()
+        self.revision = 0
+        self.reemplazar(productos)
+
+    def reemplazar(self, productos):
+        self.revision += 1
+        self.productos = {}
+        self.por_fecha = []
+        self.categorias = {}
+        # Estado previo de lo tocado desde el último journal confirmado (para deshacer si falla).
+        self.deshacer = {}
+        for i, p in enumerate(productos):
+            p = Producto.desde(p)
+            pid = p.id or f"p_{i}"
+            self.productos[pid] = p
+            self.indexar(pid, p)
+        self.por_fecha.sort()
+
+    def clave_fecha(self, pid, p):
+        return (p.fecha or EPOCA, pid)
+
+    def indexar(self, pid, p, ordenado=False):
+        if ordenado:
+            bisect.insort(self.por_fecha, self.clave_fecha(pid, p))
+        else:
+            self.por_fecha.append(self.clave_fecha(pid, p))
+        self.categorias.setdefault(p.get("categoria", ""), set()).add(pid)
+
+    def desindexar(self, pid, p):
+        clave = self.clave_fecha(pid, p)
+        i = bisect.bisect_left(self.por_fecha, clave)
+        if i < len(self.por_fecha) and self.por_fecha[i] == clave:
+            del self.por_fecha[i]
+        self.categorias.get(p.get("categoria", ""), set()).discard(pid)
+
+    def __len__(self):
+        return len(self.productos)
+
+    def __contains__(self, pid):
+        return pid in self.productos
+
+    def get(self, pid):
+        return self.productos.get(pid)
+
+    def valores(self):
+        return list(self.productos.values())
+
+    def tocar(self, p, anterior=None):
+        # Cada cambio local sube la versión del producto; la fusión con el remoto la usa.
+        p.version = version_producto(anterior or p) + 1
+        p.modificado = datetime.now(timezone.utc)
+
+    def respaldar(self, pid):
+        if pid not in self.deshacer:
+            p = self.productos.get(pid)
+            self.deshacer[pid] = p.copia() if p is not None else None
+
+    def confirmar(self):
+        self.deshacer = {}
 
-productos_db = {}
+    def revertir(self):
+        for pid, p in self.deshacer.items():
+            actual = self.productos.pop(pid, None)
+            if actual is not None:
+                self.desindexar(pid, actual)
+            if p is not None:
+                self.productos[pid] = p
+                self.indexar(pid, p, ordenado=True)
+        self.revision += 1
+        self.deshacer = {}
+
+    def agregar(self, p, local=True):
+        p = Producto.desde(p)
+        pid = p.id
+        self.respaldar(pid)
+        anterior = self.productos.get(pid)
+        if anterior is not None:
+            self.desindexar(pid, anterior)
+        if local:
+            self.tocar(p, anterior)
+        self.revision += 1
+        self.productos[pid] = p
+        self.indexar(pid, p, ordenado=True)
+        return p
+
+    def actualizar(self, pid, campo, valor):
+        return self.actualizar_campos(pid, {campo: valor})
+
+    def actualizar_campos(self, pid, cambios):
+        # Varios campos en una sola versión (y una sola entrada del journal).
+        self.respaldar(pid)
+        p = self.productos[pid]
+        self.desindexar(pid, p)
+        for campo, valor in cambios.items():
+            p[campo] = valor
+        self.tocar(p)
+        self.revision += 1
+        self.indexar(pid, p, ordenado=True)
+        return p
+
+    def eliminar(self, pid):
+        self.respaldar(pid)
+        p = self.productos.pop(pid)
+        self.revision += 1
+        self.desindexar(pid, p)
+        return p
+
+    def recientes(self, cursor=0, limite=BOTONES_POR_PAGINA):
+        # Página de productos del más nuevo al más viejo; devuelve (productos, siguiente cursor o None).
+        fin = len(self.por_fecha) - cursor
+        inicio = max(0, fin - limite)
+        pagina = [self.productos[pid] for _, pid in reversed(self.por_fecha[inicio:fin])]
+        return pagina, (cursor + limite if inicio > 0 else None)
+
+    def de_categoria(self, categoria):
+        return [self.productos[pid] for pid in self.categorias.get(categoria, ())]
+
+store = ProductStore()
+
+def version_producto(p):
+    return (p or {}).get("version", 0)
+
+def versiones(productos):
+    return {p["id"]: version_producto(p) for p in productos if p.get("id")}
+
+def fusionar(base, locales, remotos):
+    # Fusión a tres vías por producto. base: {id: versión} del último estado sincronizado.
+    # Si solo cambió un lado gana ese lado; si cambiaron ambos gana la versión más alta
+    # (y a igualdad, la modificación más reciente). Una edición le gana a un borrado.
+    resultado = {}
+    for pid in list(remotos) + [pid for pid in locales if pid not in remotos]:
+        local, remoto = locales.get(pid), remotos.get(pid)
+        cambio_local = (version_producto(local) if local else None) != base.get(pid)
+        cambio_remoto = (version_producto(remoto) if remoto else None) != base.get(pid)
+        if not cambio_remoto:
+            elegido = local
+        elif not cambio_local:
+            elegido = remoto
+        elif local is None or remoto is None:
+            elegido = local or remoto
+        else:
+            elegido = max(local, remoto, key=lambda p: (version_producto(p), p.modificado or EPOCA))
+        if elegido is not None:
+            resultado[pid] = elegido
+    return list(resultado.values())
+
+class ConflictoRemoto(Exception):
+    # El remoto avanzó desde la última sincronización: hay que fusionar antes de publicar.
+    pass
+
+class Journal:
+    # Log local append-only de cambios (put/del con el producto completo). Cada lote se
+    # sincroniza a disco antes de responder al admin, se reproduce al arrancar sobre el
+    # catálogo publicado y se compacta cuando una publicación queda confirmada.
+    def __init__(self, ruta=JOURNAL_PATH):
+        self.ruta = ruta
+        self.entradas = []
+        self.seq = 0
+        self.lock = asyncio.Lock()
+
+    def cargar(self):
+        self.entradas = []
+        if self.ruta.exists():
+            for linea in self.ruta.read_text(encoding="utf-8").splitlines():
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    # Línea cortada por un crash a mitad de escritura.
+                    continue
+                self.entradas.append(entrada)
+        self.seq = max((e["seq"] for e in self.entradas), default=0)
+        return self.entradas
+
+    def reproducir(self, store):
+        for e in self.cargar():
+            if e["op"] == "put" and version_producto(e["producto"]) >= version_producto(store.get(e["id"])):
+                store.agregar(e["producto"], local=False)
+            elif e["op"] == "del" and e["id"] in store and version_producto(store.get(e["id"])) <= e.get("version", float("inf")):
+                store.eliminar(e["id"])
+        store.confirmar()
+        return len(self.entradas)
+
+    def escribir(self, lineas):
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        with self.ruta.open("a", encoding="utf-8") as f:
+            inicio = f.tell()
+            try:
+                f.write("".join(lineas))
+                f.flush()
+                os.fsync(f.fileno())
+            except Exception:
+                # Que no quede en el log un cambio que se va a deshacer en memoria.
+                f.truncate(inicio)
+                raise
+
+    async def registrar(self, productos=(), eliminados=()):
+        async with self.lock:
+            ts = datetime.now(timezone.utc).isoformat()
+            nuevas = [{"op": "put", "id": p["id"], "producto": p} for p in productos]
+            # El borrado guarda la versión borrada: al reproducirlo, una edición más nueva le gana.
+            nuevas += [{"op": "del", "id": p["id"], "version": version_producto(p)} for p in eliminados]
+            for e in nuevas:
+                self.seq += 1
+                e.update(seq=self.seq, ts=ts)
+            await asyncio.to_thread(self.escribir, [json.dumps(e, ensure_ascii=False, default=a_json) + "\n" for e in nuevas])
+            self.entradas.extend(nuevas)
+
+    def reescribir(self, entradas):
+        tmp = self.ruta.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False, default=a_json) + "\n" for e in entradas))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta)
+
+    async def compactar(self, hasta):
+        # Descarta lo ya publicado (seq <= hasta).
+        async with self.lock:
+            restantes = [e for e in self.entradas if e["seq"] > hasta]
+            if len(restantes) == len(self.entradas):
+                return
+            await asyncio.to_thread(self.reescribir, restantes)
+            self.entradas = restantes
+
+journal = Journal()
 
 def repo_url_with_token():
+    if GIT_REMOTE_URL:
+        return GIT_REMOTE_URL
     if not GITHUB_USER or not GITHUB_REPO:
         return None
     return f"https://{GITHUB_TOKEN}@github.com/{GITHUB_USER}/{GITHUB_REPO}.git"
 
+def git(*args, timeout=None, check=False):
+    # Todas las llamadas a git pasan por aquí para medir cada paso (clone, commit, push...).
+    with medir("git_segundos", comando=args[0]):
+        return subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), *args], capture_output=True, text=True, timeout=timeout, check=check)
+
 def ensure_repo():
     try:
         repo_url = repo_url_with_token()
         if not repo_url:
             return False
         if not LOCAL_REPO_PATH.exists():
-            print(f"📥 Clonando repositorio...")
+            info("git_clonando")
             LOCAL_REPO_PATH.mkdir(parents=True, exist_ok=True)
-            result = subprocess.run(["git", "clone", "--depth", "1", repo_url, str(LOCAL_REPO_PATH)], capture_output=True, text=True, timeout=60)
+            with medir("git_segundos", comando="clone"):
+                result = subprocess.run(["git", "clone", "--depth", "1", repo_url, str(LOCAL_REPO_PATH)], capture_output=True, text=True, timeout=60)
             if result.returncode != 0:
-                print(f"❌ Error clonando: {result.stderr}")
+                error("git_clone_fallido", stderr=result.stderr)
                 return False
-            print("✅ Repositorio clonado")
+            info("git_clonado")
         else:
             git_dir = LOCAL_REPO_PATH / ".git"
             if not git_dir.exists():
                 import shutil
                 shutil.rmtree(LOCAL_REPO_PATH)
                 return ensure_repo()
-            subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "pull"], capture_output=True, timeout=30)
+            git("pull", timeout=30)
         return True
     except Exception as e:
-        print(f"❌ Error git: {e}")
+        error("git_error", error=str(e))
         return False
 
+def leer_productos(contenido):
+    productos = json.loads(contenido.decode("utf-8") if isinstance(contenido, bytes) else contenido)
+    return migrar(productos) if isinstance(productos, list) else []
+
+def leer_shards(manifest, leer):
+    productos = []
+    for shard in manifest.get("shards", []):
+        productos.extend(leer_productos(leer(shard["archivo"])))
+    return productos
+
 def load_productos_from_disk():
     ruta = LOCAL_REPO_PATH / JSON_FILENAME
-    if not ruta.exists():
+    ruta_manifest = LOCAL_REPO_PATH / MANIFEST_FILENAME
+    usar_shards = ruta_manifest.exists() and (CATALOG_LAYOUT == "shards" or not ruta.exists())
+    if not usar_shards and not ruta.exists():
         return []
     try:
-        with ruta.open("r", encoding="utf-8") as f:
-            productos = json.load(f)
-            print(f"📦 Cargados {len(productos)} productos")
-            return productos if isinstance(productos, list) else []
+        if usar_shards:
+            manifest = json.loads(ruta_manifest.read_text(encoding="utf-8"))
+            productos = leer_shards(manifest, lambda archivo: (LOCAL_REPO_PATH / archivo).read_bytes())
+        else:
+            productos = leer_productos(ruta.read_bytes())
+        info("productos_cargados", productos=len(productos), origen="disco")
+        return productos
     except Exception as e:
-        print(f"❌ Error leyendo: {e}")
+        error("productos_lectura_fallida", error=str(e))
     return []
 
-def save_and_push_productos():
+def serializar(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=a_json).encode("utf-8")
+
+def hash_contenido(contenido):
+    return hashlib.sha256(contenido).hexdigest()[:16]
+
+def nombre_shard(categoria):
+    return re.sub(r"[^a-z0-9_-]+", "_", (categoria or "").lower()).strip("_") or "otros"
+
+def normalizar(texto):
+    texto = unicodedata.normalize("NFKD", texto or "")
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower()
+
+def tokenizar(texto):
+    return re.findall(r"[a-z0-9]+", normalizar(texto))
+
+def generar_indice_busqueda(lista):
+    # Índice invertido sin tildes: tokens ordenados (para búsqueda por prefijo) -> posiciones en "productos".
+    ids = []
+    postings = {}
+    for p in lista:
+        if not p.get("id"):
+            continue
+        n = len(ids)
+        ids.append(p["id"])
+        for token in set(tokenizar(p.get("nombre")) + tokenizar(p.get("descripcion"))):
+            postings.setdefault(token, []).append(n)
+    tokens = sorted(postings)
+    return {"formato": 1, "productos": ids, "tokens": tokens, "postings": [postings[t] for t in tokens]}
+
+def sin_telegram(p):
+    # Los links de archivos de Telegram llevan el token del bot: se quedan en el store (hasta que
+    # el espejo los reemplaza) pero nunca salen en lo que se publica o se sirve.
+    if not any(es_de_telegram(u) for u in [p.get("imagen")] + list(p.get("imagenes") or []) + list(p.get("videos") or []) + list(p.get("derivados") or {})):
+        return p
+    p = p.copia() if isinstance(p, Producto) else dict(p)
+    p["imagen"] = "" if es_de_telegram(p.get("imagen")) else p.get("imagen")
+    p["imagenes"] = [u for u in p.get("imagenes") or [] if not es_de_telegram(u)]
+    p["videos"] = [u for u in p.get("videos") or [] if not es_de_telegram(u)]
+    p["derivados"] = {u: d for u, d in (p.get("derivados") or {}).items() if not es_de_telegram(u)}
+    return p
+
+def publicables(lista):
+    return [sin_telegram(p) for p in lista]
+
+def generar_archivos(lista):
+    # Devuelve {ruta: bytes} con todo lo que se publica para la lista de productos.
+    lista = publicables(lista)
+    if CATALOG_LAYOUT != "shards":
+        archivos = {JSON_FILENAME: serializar(lista)}
+    else:
+        grupos = {}
+        for p in lista:
+            grupos.setdefault(nombre_shard(p.get("categoria")), []).append(p)
+        archivos = {}
+        shards = []
+        for nombre, productos in grupos.items():
+            archivo = f"{SHARDS_DIR}/{nombre}.json"
+            archivos[archivo] = serializar(productos)
+            shards.append({"categoria": nombre, "archivo": archivo, "hash": hash_contenido(archivos[archivo]), "productos": len(productos)})
+        archivos[MANIFEST_FILENAME] = serializar({"formato": 1, "shards": shards})
+    archivos[SEARCH_INDEX_FILENAME] = json.dumps(generar_indice_busqueda(lista), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    archivos[VERSION_FILENAME] = generar_version(archivos, len(lista))
+    if prerender.activo():
+        archivos.update(prerender.grillas(lista, json.loads(archivos[VERSION_FILENAME])["version"]))
+    return archivos
+
+def shards_huerfanos(archivos):
+    # Shards que siguen en el remoto pero el manifest ya no lista (categoría vacía): se borran.
+    # Con layout single no se lista ninguno, así que se van todos, manifest incluido.
+    return {ruta: None for ruta in backend.rutas() if ruta.startswith(f"{SHARDS_DIR}/") and ruta.endswith(".json") and ruta not in archivos}
+
+def generar_version(archivos, total):
+    # Manifiesto mínimo que la página consulta en cada refresco.
+    version = hash_contenido("".join(hash_contenido(archivos[r]) for r in sorted(archivos)).encode("ascii"))
+    return json.dumps({"version": version, "actualizado": datetime.now(timezone.utc).isoformat(), "productos": total, "layout": CATALOG_LAYOUT, "esquema": ESQUEMA}).encode("utf-8")
+
+def tamano_archivos(archivos):
+    return sum(len(c) for c in archivos.values() if c is not None)
+
+def guardar_local(archivos):
+    # Contenido None: el archivo se borra (shard de una categoría que quedó vacía).
+    for ruta, contenido in archivos.items():
+        destino = LOCAL_REPO_PATH / ruta
+        if contenido is None:
+            destino.unlink(missing_ok=True)
+            continue
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        destino.write_bytes(contenido)
+
+# ── Páginas pre-renderizadas ──
+# plantilla.html es la fuente: en cada publicación se generan index.html y una página por
+# categoría con la primera tanda de tarjetas ya pintada entre <!--grilla--> y <!--/grilla-->,
+# que el JS adopta al cargar; y p/<id>.html por producto con etiquetas OpenGraph para WhatsApp.
+# La salida sigue siendo una plantilla válida (se puede volver a renderizar sobre sí misma).
+
+# Encabeza cada página generada (y sobrevive a minificar_html): quien abra index.html ve que no se edita a mano.
+MARCA_GENERADO = "<!-- Generado por el bot desde plantilla.html: NO EDITAR, se sobrescribe en cada publicación. Los cambios van en plantilla.html. -->"
+
+PAGINA_CSS = ".pagina-producto{max-width:520px;margin:0 auto;padding:1.5rem 1rem 3rem;position:relative;z-index:1}.pagina-producto .logo{display:flex;flex-direction:column;margin-bottom:1.2rem;color:inherit;text-decoration:none}.pagina-producto .product-card{cursor:default}.pagina-producto .wa-btn{text-decoration:none}.volver{display:block;margin-top:1.2rem;color:var(--gold);font-size:.85rem}"
+
+def minificar_css(css):
+    # Sin comentarios ni espacios de más; el contenido de las cadenas no se toca.
+    partes = re.split(r"""("[^"]*"|'[^']*')""", re.sub(r"/\*.*?\*/", "", css, flags=re.S))
+    for i in range(0, len(partes), 2):
+        texto = re.sub(r"\s*([{};,>])\s*", r"\1", re.sub(r"\s+", " ", partes[i]))
+        partes[i] = re.sub(r":\s+", ":", texto)
+    return "".join(partes).replace(";}", "}").strip()
+
+def minificar_html(texto):
+    # Los <script> se dejan tal cual (comentarios // de línea); el CSS se minifica aparte.
+    partes = re.split(r"(<script\b.*?</script>|<style\b.*?</style>)", texto, flags=re.S | re.I)
+    for i, parte in enumerate(partes):
+        if i % 2 == 0:
+            parte = re.sub(r"<!--(?!/?grilla-->| Generado por el bot ).*?-->", "", parte, flags=re.S)
+            partes[i] = re.sub(r">\s+<", "><", re.sub(r"\s+", " ", parte))
+        elif parte[:6].lower() == "<style":
+            inicio = parte.index(">") + 1
+            partes[i] = parte[:inicio] + minificar_css(parte[inicio:-8]) + "</style>"
+    return "".join(partes).strip()
+
+def reglas_css(css):
+    # [(selector o @regla, cuerpo)] de primer nivel, respetando llaves anidadas (@media).
+    reglas, nivel, previo, inicio = [], 0, 0, 0
+    for i, c in enumerate(css):
+        if c == "{":
+            if nivel == 0:
+                inicio = i
+            nivel += 1
+        elif c == "}":
+            nivel -= 1
+            if nivel == 0:
+                reglas.append((css[previo:inicio].strip(), css[inicio + 1:i]))
+                previo = i + 1
+    return reglas
+
+def css_critico(css, clases):
+    # Solo las reglas cuyos selectores usan clases presentes en la página.
+    salida = []
+    for selector, cuerpo in reglas_css(css):
+        if selector.startswith("@media"):
+            interno = css_critico(cuerpo, clases)
+            if interno:
+                salida.append(f"{selector}{{{interno}}}")
+        elif selector.startswith("@") or any(set(re.findall(r"\.([\w-]+)", s)) <= clases for s in selector.split(",")):
+            salida.append(f"{selector}{{{cuerpo}}}")
+    return "".join(salida)
+
+def firma_producto(p):
+    return hash_contenido(json.dumps(p, ensure_ascii=False, sort_keys=True, default=a_json).encode("utf-8"))
+
+def nombre_pagina(pid):
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(pid))
+
+def precio_texto(precio):
+    # Igual que fmtPrice() en index.html (toLocaleString es-CO): 120.000 / 12,5
+    if isinstance(precio, int):
+        return f"{precio:,}".replace(",", ".")
+    try:
+        texto = f"{float(precio):,.3f}".rstrip("0").rstrip(".")
+    except (TypeError, ValueError):
+        return str(precio)
+    return texto.translate(str.maketrans(",.", ".,"))
+
+def medios_producto(p):
+    derivados = p.get("derivados") or {}
+    medios = [{"tipo": "imagen", "url": u, **derivados.get(u, {})} for u in [p.get("imagen")] + list(p.get("imagenes") or []) if u]
+    return medios + [{"tipo": "video", "url": u, **derivados.get(u, {})} for u in p.get("videos") or [] if u]
+
+def texto_js(valor):
+    return str(valor or "").replace("\\", "\\\\").replace("'", "\\'")
+
+def html_tarjeta(p):
+    # Mismo marcado que buildCard() en index.html; k identifica el carrusel (ct-k / cd-k).
+    e = html.escape
+    k = "p-" + nombre_pagina(p.get("id"))
+    medios = medios_producto(p)
+    nombre = e(p.get("nombre") or "")
+    slides = ""
+    for m in medios:
+        if m["tipo"] == "video":
+            poster = f' poster="{e(m["poster"])}"' if m.get("poster") else ""
+            slides += f'<div class="carousel-slide"><video data-src="{e(m["url"])}"{poster} preload="none" muted loop playsinline></video></div>'
+        else:
+            srcset = [f"{e(m[n])} {ancho}w" for n, ancho in TAMANOS_DERIVADOS.items() if m.get(n)]
+            atributos = f' srcset="{", ".join(srcset)}" sizes="(max-width: 480px) 100vw, (max-width: 768px) 50vw, 360px"' if srcset else ""
+            slides += f'<div class="carousel-slide"><img src="{e(m.get("medium") or m["url"])}"{atributos} alt="{nombre}" loading="lazy" decoding="async"></div>'
+    media = f'<div class="carousel-track" id="ct-{k}">{slides}</div>' if medios else '<div class="no-img">👟</div>'
+    if len(medios) > 1:
+        puntos = "".join(f'<div class="dot{" active" if i == 0 else ""}" onclick="event.stopPropagation();goCard(\'{k}\',{i})"></div>' for i in range(len(medios)))
+        media += (f'<button class="carousel-nav prev" onclick="event.stopPropagation();navCard(\'{k}\',-1)">‹</button>'
+                  f'<button class="carousel-nav next" onclick="event.stopPropagation();navCard(\'{k}\',1)">›</button>'
+                  f'<div class="carousel-dots" id="cd-{k}">{puntos}</div><div class="media-badge">📷 {len(medios)}</div>')
+    media += f'<div class="card-cat">{"Ropa" if p.get("categoria") == "ropa" else "Zapatillas"}</div>'
+    datos = f'<h3 class="card-name">{nombre}</h3>'
+    if p.get("descripcion"):
+        datos += f'<p class="card-desc">{e(p["descripcion"])}</p>'
+    tallas = f'<div class="card-sizes">📏 {e(p["tallas"])}</div>' if p.get("tallas") else ""
+    consulta = e(f"event.stopPropagation();askWa('{texto_js(p.get('nombre'))}','{texto_js(p.get('precio'))}','{texto_js(p.get('tallas'))}')")
+    datos += (f'<div class="card-bottom"><div class="card-price-wrap"><div class="price-tag">Precio</div><div class="card-price">${precio_texto(p.get("precio"))}</div>{tallas}</div>'
+              f'<button class="wa-btn" onclick="{consulta}"><span class="wa-icon">💬</span> Consultar</button></div>')
+    return f'<div class="product-card" data-id="{e(str(p.get("id") or ""))}"><div class="card-media">{media}</div><div class="card-info">{datos}</div></div>'
+
+class Prerender:
+    # Las tarjetas se cachean por firma del producto: en cada publicación solo se renderizan las
+    # que cambiaron y las grillas son concatenaciones. Las páginas por producto solo se generan
+    # si su firma difiere de la publicada (o del blob que ya está en el remoto tras reiniciar).
+    def __init__(self, plantilla=PRERENDER_TEMPLATE):
+        self.ruta = plantilla
+        self.mtime = None
+        self.partes = None
+        self.tarjetas = {}
+        self.publicadas = {}
+        self.pendientes = {}
+
+    def activo(self):
+        return PRERENDER and self.ruta.exists()
+
+    def plantilla(self):
+        mtime = self.ruta.stat().st_mtime
+        if mtime != self.mtime:
+            texto = minificar_html(self.ruta.read_text(encoding="utf-8"))
+            if MARCA_GENERADO not in texto:
+                texto = re.sub(r"^(<!DOCTYPE html>)?", lambda m: (m.group(0) or "") + MARCA_GENERADO, texto, count=1, flags=re.I)
+            inicio, fin = texto.index("<!--grilla-->") + len("<!--grilla-->"), texto.index("<!--/grilla-->")
+            telefono = re.search(r"whatsappNumbers:\s*\[\s*'(\d+)'", texto)
+            fuentes = re.search(r'<link href="https://fonts[^>]*>', texto)
+            self.partes = {"antes": texto[:inicio], "despues": texto[fin:], "telefono": telefono.group(1) if telefono else "",
+                           "fuentes": fuentes.group(0) if fuentes else "", "css": ""}
+            # El CSS crítico de las páginas de producto sale de las clases que usa una página de ejemplo.
+            ejemplo = {"id": "x", "nombre": "x", "precio": "1", "descripcion": "x", "tallas": "x", "imagen": "x", "imagenes": ["x"], "videos": ["x"]}
+            clases = set(" ".join(re.findall(r'class="([^"]+)"', self.pagina(ejemplo).decode("utf-8"))).split())
+            self.partes["css"] = css_critico(re.search(r"<style>(.*?)</style>", texto, re.S).group(1), clases) + PAGINA_CSS
+            self.mtime = mtime
+        return self.partes
+
+    def tarjeta(self, p):
+        clave = p.get("id") or firma_producto(p)
+        firma = firma_producto(p)
+        cache = self.tarjetas.get(clave)
+        if cache is None or cache[0] != firma:
+            cache = self.tarjetas[clave] = (firma, html_tarjeta(p))
+        return cache[1]
+
+    def grilla(self, lista, total, version, categoria=None):
+        partes = self.plantilla()
+        visibles = [p for p in lista if not categoria or (p.get("categoria") or "").lower() == categoria]
+        # Solo la primera ventana: el resto lo agrega el JS al hacer scroll (como en render()).
+        tarjetas = [self.tarjeta(p) for p in visibles[:PRERENDER_TARJETAS]]
+        # Las primeras imágenes cargan sin lazy, como en buildCard().
+        tarjetas[:4] = [t.replace('loading="lazy"', 'loading="eager"', 1) for t in tarjetas[:4]]
+        cuerpo = "".join(tarjetas) or '<div class="empty"><span class="empty-icon">📦</span><h3>Sin resultados</h3><p>No encontramos productos con esa búsqueda.</p></div>'
+        antes = re.sub(r'<div class="products-grid" id="grid"[^>]*>', f'<div class="products-grid" id="grid" data-version="{version}" data-categoria="{categoria or "todos"}">', partes["antes"])
+        antes = re.sub(r'(id="statProducts">)[^<]*', rf"\g<1>{total}", antes)
+        antes = re.sub(r'(id="countDisplay">)[^<]*', rf"\g<1>{len(visibles)}", antes)
+        antes = re.sub(r"""class="tab-btn(?: active)?"( onclick="filterCat\('(\w+)')""", lambda m: f'class="tab-btn{" active" if m.group(2) == (categoria or "todos") else ""}"{m.group(1)}', antes)
+        if categoria:
+            antes = re.sub(r"<title>(.*?)</title>", lambda m: f"<title>{categoria.title()} · {m.group(1)}</title>", antes, count=1)
+        return (antes + cuerpo + partes["despues"]).encode("utf-8")
+
+    def grillas(self, lista, version):
+        archivos = {"index.html": self.grilla(lista, len(lista), version)}
+        for categoria in CATEGORIAS:
+            archivos[f"categoria-{categoria}.html"] = self.grilla(lista, len(lista), version, categoria)
+        if len(self.tarjetas) > len(lista):
+            vigentes = {p.get("id") or firma_producto(p) for p in lista}
+            self.tarjetas = {k: v for k, v in self.tarjetas.items() if k in vigentes}
+        return archivos
+
+    def pagina(self, p):
+        partes = self.partes
+        e = html.escape
+        nombre = p.get("nombre") or ""
+        imagen = next((m.get("medium") or m["url"] for m in medios_producto(p) if m["tipo"] == "imagen"), "")
+        descripcion = f"${precio_texto(p.get('precio'))}" + (f" · Tallas {p['tallas']}" if p.get("tallas") else "") + (f" · {p['descripcion']}" if p.get("descripcion") else "")
+        url = f"{SITE_URL}{PAGINAS_DIR}/{nombre_pagina(p.get('id'))}.html" if SITE_URL else ""
+        mensaje = f"¡Hola! Estoy interesado en *{nombre}*.\nPrecio: ${precio_texto(p.get('precio'))}" + (f"\nTallas: {p['tallas']}" if p.get("tallas") else "") + "\n¿Está disponible? 👟"
+        wa = f"https://wa.me/{partes['telefono']}?text={quote(mensaje)}" if partes["telefono"] else "../"
+        tarjeta = re.sub(r'<button class="wa-btn"[^>]*>(.*?)</button>', lambda m: f'<a class="wa-btn" href="{e(wa)}" target="_blank" rel="noopener">{m.group(1)}</a>', html_tarjeta(dict(p, imagenes=[], videos=[])))
+        tarjeta = tarjeta.replace('loading="lazy"', 'loading="eager"')
+        meta = [("og:type", "product"), ("og:title", nombre), ("og:description", descripcion), ("og:image", imagen), ("og:url", url),
+                ("product:price:amount", p.get("precio") or ""), ("product:price:currency", "COP")]
+        cabecera = "".join(f'<meta property="{k}" content="{e(str(v))}">' for k, v in meta if v)
+        if url:
+            cabecera += f'<link rel="canonical" href="{e(url)}">'
+        return ('<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">'
+                f'<title>{e(nombre)} — Under Shopp</title><meta name="description" content="{e(descripcion)}">{cabecera}'
+                f'<meta name="twitter:card" content="summary_large_image">{partes["fuentes"]}<style>{partes["css"]}</style></head>'
+                f'<body><main class="pagina-producto"><a class="logo" href="../"><span class="logo-main">UNDER SHOPP</span><span class="logo-sub">Premium</span></a>'
+                f'{tarjeta}<a class="volver" href="../">← Ver catálogo completo</a></main></body></html>').encode("utf-8")
+
+    def pagina_retirada(self):
+        return ('<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8"><meta name="robots" content="noindex"><meta http-equiv="refresh" content="0; url=../">'
+                '<title>Producto no disponible — Under Shopp</title></head><body><a href="../">Ver catálogo</a></body></html>').encode("utf-8")
+
+    def paginas_cambiadas(self, lista):
+        self.plantilla()
+        cambiadas, vigentes = {}, set()
+        self.pendientes = {}
+        for p in lista:
+            ruta = f"{PAGINAS_DIR}/{nombre_pagina(p.get('id'))}.html"
+            vigentes.add(ruta)
+            firma = firma_producto(p)
+            if self.publicadas.get(ruta) == firma:
+                continue
+            contenido = self.pagina(p)
+            if ruta not in self.publicadas and backend.sha_blob(ruta) == git_blob_sha(contenido):
+                # Ya está en el remoto (p. ej. tras reiniciar): no se vuelve a subir.
+                self.publicadas[ruta] = firma
+                continue
+            cambiadas[ruta] = contenido
+            self.pendientes[ruta] = firma
+        for ruta, firma in self.publicadas.items():
+            if ruta not in vigentes and firma != "retirada":
+                cambiadas[ruta] = self.pagina_retirada()
+                self.pendientes[ruta] = "retirada"
+        return cambiadas
+
+    def confirmar(self, archivos):
+        for ruta in archivos:
+            if ruta in self.pendientes:
+                self.publicadas[ruta] = self.pendientes.pop(ruta)
+
+prerender = Prerender()
+
+def save_and_push_productos(archivos=None):
     try:
         if not LOCAL_REPO_PATH.exists():
             LOCAL_REPO_PATH.mkdir(parents=True, exist_ok=True)
         git_dir = LOCAL_REPO_PATH / ".git"
         if not git_dir.exists():
             ensure_repo()
-        ruta = LOCAL_REPO_PATH / JSON_FILENAME
-        lista = list(productos_db.values())
-        with ruta.open("w", encoding="utf-8") as f:
-            json.dump(lista, f, ensure_ascii=False, indent=2)
+        if archivos is None:
+            archivos = generar_archivos(store.valores())
+        guardar_local(archivos)
         if not git_dir.exists():
             return True
-        subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "config", "user.email", "bot@local"], capture_output=True)
-        subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "config", "user.name", "Bot"], capture_output=True)
-        subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "add", JSON_FILENAME], capture_output=True)
-        res = subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "status", "--porcelain"], capture_output=True, text=True)
-        if res.stdout.strip() == "":
-            return True
-        subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "commit", "-m", "Bot update"], capture_output=True)
+        git("config", "user.email", "bot@local")
+        git("config", "user.name", "Bot")
+        borrados = [ruta for ruta, contenido in archivos.items() if contenido is None]
+        if borrados:
+            git("rm", "-q", "--cached", "--ignore-unmatch", "--", *borrados)
+        git("add", "--", *[ruta for ruta in archivos if ruta not in borrados])
+        res = git("status", "--porcelain")
+        if res.stdout.strip() != "":
+            git("commit", "-m", "Bot update")
         repo_url = repo_url_with_token()
         if repo_url:
-            subprocess.run(["git", "-C", str(LOCAL_REPO_PATH), "push", repo_url, REPO_BRANCH], capture_output=True, timeout=30)
-        print("✅ Push exitoso")
+            # Se empuja aunque no haya commit nuevo: puede quedar uno pendiente de un push fallido.
+            res = git("push", repo_url, f"HEAD:{REPO_BRANCH}", timeout=30)
+            if res.returncode != 0:
+                if any(x in res.stderr for x in ("rejected", "fetch first", "non-fast-forward")):
+                    raise ConflictoRemoto(res.stderr)
+                error("git_push_fallido", stderr=res.stderr)
+                return False
+        info("git_push_ok", archivos=len(archivos), bytes=tamano_archivos(archivos))
         return True
+    except ConflictoRemoto:
+        raise
     except Exception as e:
-        print(f"⚠️ Error: {e}")
+        error("git_publicar_fallido", error=str(e))
+        return False
+
+class GitCLIBackend:
+    nombre = "git"
+
+    def __init__(self):
+        # SHA de cada blob en el remoto (no en el checkout, que puede ir adelantado tras un push fallido).
+        self.shas = {}
+
+    async def publicar(self, archivos):
+        ok = await asyncio.to_thread(save_and_push_productos, archivos)
+        if ok:
+            for ruta, contenido in archivos.items():
+                if contenido is None:
+                    self.shas.pop(ruta, None)
+                else:
+                    self.shas[ruta] = git_blob_sha(contenido)
+        return ok
+
+    def sha_blob(self, ruta):
+        return self.shas.get(ruta)
+
+    def rutas(self):
+        return list(self.shas)
+
+    def traer_remoto(self):
+        if not (LOCAL_REPO_PATH / ".git").exists() and not ensure_repo():
+            raise RuntimeError("no se pudo clonar el repositorio")
+        repo_url = repo_url_with_token()
+        git("fetch", repo_url, REPO_BRANCH, check=True, timeout=30)
+        git("reset", "--hard", "FETCH_HEAD", check=True)
+        self.shas = {}
+        for linea in git("ls-tree", "-r", "HEAD").stdout.splitlines():
+            sha, ruta = linea.split(" ", 2)[2].split("\t", 1)
+            self.shas[ruta] = sha
+        return load_productos_from_disk()
+
+    async def remoto(self):
+        return await asyncio.to_thread(self.traer_remoto)
+
+    async def cerrar(self):
+        pass
+
+def operacion_github(url):
+    # /repos/u/r/contents/x.json -> contents, /repos/u/r/git/refs/heads/main -> git/refs
+    partes = url.path.split("/")[4:]
+    return "/".join(partes[:2]) if partes[:1] == ["git"] else (partes[0] if partes else "")
+
+async def inicio_peticion(request):
+    request.extensions["inicio"] = time.perf_counter()
+
+async def fin_peticion(response):
+    request = response.request
+    metricas.observar("github_segundos", time.perf_counter() - request.extensions["inicio"], metodo=request.method, operacion=operacion_github(request.url), estado=response.status_code)
+
+def git_blob_sha(contenido):
+    return hashlib.sha1(b"blob %d\0" % len(contenido) + contenido).hexdigest()
+
+class GitHubAPIBackend:
+    # Cada publicación es un solo commit con la Git Data API (tree + commit + ref), condicionado
+    # a que la rama siga en el commit que leímos. Si el remoto avanzó: ConflictoRemoto.
+    # (Siempre van al menos los datos y version.json: el PUT de un archivo suelto por la API de
+    # contenidos no tendría cuándo usarse.)
+    nombre = "api"
+
+    def __init__(self, base_url=GITHUB_API_URL, user=GITHUB_USER, repo=GITHUB_REPO, token=GITHUB_TOKEN, branch=REPO_BRANCH):
+        self.base_url = base_url
+        self.repo = f"/repos/{user}/{repo}"
+        self.token = token
+        self.branch = branch
+        self.shas = {}
+        self.head = None
+        self.client = None
+
+    def cliente(self):
+        if self.client is None:
+            headers = {"Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"}
+            if self.token:
+                headers["Authorization"] = f"Bearer {self.token}"
+            self.client = httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=30.0, limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+                                            event_hooks={"request": [inicio_peticion], "response": [fin_peticion]})
+        return self.client
+
+    async def leer_head(self):
+        resp = await self.cliente().get(f"{self.repo}/git/ref/heads/{self.branch}")
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()["object"]["sha"]
+
+    async def leer(self, ruta):
+        resp = await self.cliente().get(f"{self.repo}/contents/{ruta}", params={"ref": self.branch})
+        if resp.status_code == 404:
+            self.shas.pop(ruta, None)
+            return None
+        resp.raise_for_status()
+        data = resp.json()
+        self.shas[ruta] = data.get("sha")
+        if data.get("encoding") == "base64" and data.get("content"):
+            return base64.b64decode(data["content"])
+        # Archivos > 1 MB no traen contenido: se pide el blob por la Git Data API.
+        resp = await self.cliente().get(f"{self.repo}/git/blobs/{self.shas[ruta]}")
+        resp.raise_for_status()
+        return base64.b64decode(resp.json().get("content", ""))
+
+    async def leer_remoto(self):
+        # El head se lee antes que los archivos: si la rama se mueve en medio, el próximo
+        # publicar lo detecta como conflicto en vez de pisar cambios.
+        self.head = await self.leer_head()
+        if self.head:
+            # SHA de cada blob del remoto: permite saber qué archivos ya están publicados sin bajarlos.
+            resp = await self.cliente().get(f"{self.repo}/git/trees/{self.head}", params={"recursive": "1"})
+            if resp.status_code == 200:
+                self.shas.update({e["path"]: e["sha"] for e in resp.json().get("tree", []) if e.get("type") == "blob"})
+        archivos = {}
+        manifest = await self.leer(MANIFEST_FILENAME) if CATALOG_LAYOUT == "shards" else None
+        if manifest is not None:
+            archivos[MANIFEST_FILENAME] = manifest
+            for shard in json.loads(manifest).get("shards", []):
+                archivos[shard["archivo"]] = await self.leer(shard["archivo"]) or b"[]"
+            productos = leer_shards(json.loads(manifest), archivos.get)
+        else:
+            contenido = await self.leer(JSON_FILENAME)
+            if contenido is None:
+                return [], archivos
+            archivos[JSON_FILENAME] = contenido
+            productos = leer_productos(contenido)
+        await asyncio.to_thread(guardar_local, archivos)
+        return productos, archivos
+
+    async def remoto(self):
+        productos, _ = await self.leer_remoto()
+        info("productos_cargados", productos=len(productos), origen="api")
+        return productos
+
+    async def publicar(self, archivos):
+        try:
+            await asyncio.to_thread(guardar_local, archivos)
+            ok = await self.publicar_commit(archivos)
+            if ok:
+                info("github_publicado", archivos=len(archivos), bytes=tamano_archivos(archivos), head=self.head)
+            return ok
+        except ConflictoRemoto:
+            raise
+        except Exception as e:
+            error("github_error", error=str(e))
+        return False
+
+    async def publicar_commit(self, archivos):
+        c = self.cliente()
+        # sha None en el tree borra el archivo.
+        tree = [{"path": ruta, "mode": "100644", "type": "blob", **({"sha": None} if contenido is None else {"content": contenido.decode("utf-8")})} for ruta, contenido in archivos.items()]
+        padre = await self.leer_head()
+        if self.head and padre != self.head:
+            raise ConflictoRemoto(f"{self.branch} avanzó a {padre}")
+        resp = await c.get(f"{self.repo}/git/commits/{padre}")
+        resp.raise_for_status()
+        resp = await c.post(f"{self.repo}/git/trees", json={"base_tree": resp.json()["tree"]["sha"], "tree": tree})
+        resp.raise_for_status()
+        resp = await c.post(f"{self.repo}/git/commits", json={"message": "Bot update", "tree": resp.json()["sha"], "parents": [padre]})
+        resp.raise_for_status()
+        commit = resp.json()["sha"]
+        resp = await c.patch(f"{self.repo}/git/refs/heads/{self.branch}", json={"sha": commit})
+        if resp.status_code == 422:
+            raise ConflictoRemoto(f"{self.branch} no avanza en fast-forward")
+        if resp.status_code != 200:
+            error("github_error", estado=resp.status_code, respuesta=resp.text[:200])
+            return False
+        self.head = commit
+        for ruta, contenido in archivos.items():
+            if contenido is None:
+                self.shas.pop(ruta, None)
+            else:
+                self.shas[ruta] = git_blob_sha(contenido)
+        return True
+
+    def sha_blob(self, ruta):
+        return self.shas.get(ruta)
+
+    def rutas(self):
+        return list(self.shas)
+
+    async def cerrar(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+def crear_backend():
+    if PUBLISH_BACKEND == "git":
+        return GitCLIBackend()
+    return GitHubAPIBackend()
+
+backend = crear_backend()
+
+def cargar_snapshot():
+    # Último catálogo conocido, para arrancar sin esperar al remoto.
+    try:
+        data = json.loads(SNAPSHOT_PATH.read_text(encoding="utf-8"))
+        info("snapshot_cargado", version=data.get("version"), guardado=data.get("guardado"), productos=len(data["productos"]))
+        return data["productos"]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        aviso("snapshot_invalido", error=str(e))
+        return None
+
+def guardar_snapshot(lista):
+    contenido = json.dumps(lista, ensure_ascii=False, separators=(",", ":"), default=a_json)
+    data = {"version": hash_contenido(contenido.encode("utf-8")), "guardado": datetime.now(timezone.utc).isoformat(), "esquema": ESQUEMA, "productos": lista}
+    SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = SNAPSHOT_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=a_json), encoding="utf-8")
+    os.replace(tmp, SNAPSHOT_PATH)
+
+class Publicador:
+    # Agrupa ráfagas de cambios en una sola escritura + commit + push fuera del event loop.
+    def __init__(self, espera=PUBLISH_DEBOUNCE_SECONDS):
+        self.espera = espera
+        self.evento = asyncio.Event()
+        self.cambios = 0
+        self.chats = set()
+        self.tarea = None
+        self.tarea_sync = None
+        self.publicando = asyncio.Lock()
+        self.publicados = {}
+        self.base = {}
+        # No se publica hasta haber visto el remoto al menos una vez (conflictos detectables).
+        self.sincronizado = asyncio.Event()
+        # Sin snapshot el journal espera al remoto: un borrado pendiente tiene que encontrar el producto.
+        self.journal_pendiente = False
+
+    def marcar(self, chat_id=None):
+        self.cambios += 1
+        if chat_id is not None:
+            self.chats.add(chat_id)
+        self.evento.set()
+
+    def iniciar(self, app):
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self.run(app))
+        if not self.sincronizado.is_set():
+            self.tarea_sync = asyncio.create_task(self.sincronizar_en_fondo())
+
+    async def run(self, app):
+        while True:
+            await self.evento.wait()
+            # Debounce: seguir esperando mientras sigan llegando cambios.
+            while True:
+                self.evento.clear()
+                try:
+                    await asyncio.wait_for(self.evento.wait(), timeout=self.espera)
+                except asyncio.TimeoutError:
+                    break
+            await self.sincronizado.wait()
+            await self.publicar(app)
+
+    async def sincronizar(self):
+        # Trae el remoto y lo fusiona con lo que ya se está sirviendo (snapshot + journal).
+        t = time.perf_counter()
+        try:
+            remotos = await backend.remoto()
+        except Exception as e:
+            error("sincronizacion_fallida", error=str(e))
+            return False
+        async with store.lock:
+            fusion = fusionar(self.base, store.productos, {p.get("id") or f"p_{i}": p for i, p in enumerate(remotos)})
+            store.reemplazar(fusion)
+            self.base = versiones(remotos)
+            if self.journal_pendiente:
+                self.journal_pendiente = False
+                recuperados = journal.reproducir(store)
+                if recuperados:
+                    info("journal_recuperado", cambios=recuperados)
+            pendiente = versiones(store.valores()) != self.base
+        await asyncio.to_thread(guardar_snapshot, remotos)
+        self.sincronizado.set()
+        if pendiente:
+            self.marcar()
+        TIEMPOS_ARRANQUE["sync"] = time.perf_counter() - t
+        metricas.observar("sincronizar_segundos", TIEMPOS_ARRANQUE["sync"])
+        info("sincronizado", segundos=round(TIEMPOS_ARRANQUE["sync"], 3), productos=len(store))
         return True
 
+    async def sincronizar_en_fondo(self):
+        espera = 5
+        while not await self.sincronizar():
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 300)
+
+    def sin_cambios(self, ruta, contenido):
+        if ruta in self.publicados:
+            return self.publicados[ruta] == hash_contenido(contenido)
+        # Primera vez desde el arranque o una reconciliación: se compara con el blob del remoto.
+        if backend.sha_blob(ruta) == git_blob_sha(contenido):
+            self.publicados[ruta] = hash_contenido(contenido)
+            return True
+        return False
+
+    def copia_store(self):
+        # Con store.lock tomado. actualizar() muta los productos en sitio: el hilo que genera
+        # los archivos trabaja sobre copias. publicados y prerender solo se tocan con self.publicando.
+        return [p.copia() for p in store.valores()]
+
+    def archivos_cambiados(self, lista):
+        lista = publicables(lista)
+        archivos = generar_archivos(lista)
+        cambiados = {ruta: contenido for ruta, contenido in archivos.items() if ruta != VERSION_FILENAME and not self.sin_cambios(ruta, contenido)}
+        cambiados.update(shards_huerfanos(archivos))
+        if cambiados:
+            # version.json lleva la fecha de publicación: solo se sube si cambió algún dato.
+            cambiados[VERSION_FILENAME] = archivos[VERSION_FILENAME]
+        if prerender.activo():
+            cambiados.update(prerender.paginas_cambiadas(lista))
+        return cambiados
+
+    async def publicar(self, app=None):
+        async with self.publicando:
+            if not self.cambios or not self.sincronizado.is_set():
+                return not self.cambios
+            cambios, chats = self.cambios, self.chats
+            self.cambios, self.chats = 0, set()
+            self.evento.clear()
+            async with store.lock:
+                seq = journal.seq
+                lista = self.copia_store()
+                base = versiones(lista)
+            # Regenerar (serializar, índice, prerender) en un hilo sin frenar a los handlers.
+            archivos = await asyncio.to_thread(self.archivos_cambiados, lista)
+            t = time.perf_counter()
+            try:
+                ok = await backend.publicar(archivos) if archivos else True
+            except ConflictoRemoto as e:
+                aviso("conflicto_remoto", detalle=str(e))
+                contar("conflictos")
+                ok, base, archivos, seq = await self.reconciliar()
+                lista = None
+            metricas.observar("publicar_segundos", time.perf_counter() - t, backend=backend.nombre, resultado="ok" if ok else "error")
+            contar("publicaciones", resultado="ok" if ok else "error")
+            if ok and archivos:
+                contar("bytes_publicados", tamano_archivos(archivos))
+            info("publicacion", ok=ok, cambios=cambios, archivos=len(archivos or ()), segundos=round(time.perf_counter() - t, 3))
+            if ok:
+                self.base = base
+                for ruta, contenido in archivos.items():
+                    if contenido is None:
+                        self.publicados.pop(ruta, None)
+                    else:
+                        self.publicados[ruta] = hash_contenido(contenido)
+                prerender.confirmar(archivos)
+                await journal.compactar(seq)
+                await asyncio.to_thread(guardar_snapshot, lista if lista is not None else store.valores())
+            else:
+                # Reintentar en la siguiente ronda sin perder los cambios pendientes.
+                self.cambios += cambios
+                self.chats |= chats
+            if app is not None:
+                texto = f"🌐 Catálogo publicado ({cambios} cambios)" if ok else "⚠️ Error publicando, se reintentará"
+                for chat_id in chats:
+                    try:
+                        await app.bot.send_message(chat_id, texto)
+                    except Exception as e:
+                        aviso("notificacion_fallida", chat=chat_id, error=str(e))
+            if not ok:
+                await asyncio.sleep(self.espera)
+                self.evento.set()
+            return ok
+
+    async def reconciliar(self, intentos=3):
+        # Trae el remoto, lo fusiona producto a producto con el store y publica el resultado.
+        for _ in range(intentos):
+            try:
+                remotos = await backend.remoto()
+            except Exception as e:
+                error("remoto_lectura_fallida", error=str(e))
+                break
+            async with store.lock:
+                fusion = fusionar(self.base, store.productos, {p.get("id") or f"p_{i}": p for i, p in enumerate(remotos)})
+                store.reemplazar(fusion)
+                self.base = versiones(remotos)
+                self.publicados = {}
+                prerender.publicadas = {}
+                seq = journal.seq
+                lista = self.copia_store()
+                base = versiones(lista)
+            archivos = await asyncio.to_thread(self.archivos_cambiados, lista)
+            try:
+                return await backend.publicar(archivos), base, archivos, seq
+            except ConflictoRemoto:
+                continue
+        return False, None, None, None
+
+    async def detener(self, app=None):
+        if self.tarea_sync:
+            self.tarea_sync.cancel()
+            self.tarea_sync = None
+        if self.tarea:
+            # Con el lock tomado: cancelar a mitad de un push dejaría el hilo empujando en paralelo al último.
+            async with self.publicando:
+                # En 3.11 wait_for se traga la cancelación si el evento llega en el mismo ciclo: se insiste.
+                while not self.tarea.done():
+                    self.tarea.cancel()
+                    await asyncio.wait([self.tarea], timeout=0.1)
+            self.tarea = None
+        await self.publicar(app)
+
+publicador = Publicador()
+
+ERROR_GUARDANDO = "❌ No se pudo guardar el cambio (falló el journal en disco), intenta de nuevo"
+
+def publicar_cambios(chat_id=None):
+    publicador.marcar(chat_id)
+
+async def confirmar_cambios(chat_id, productos=(), eliminados=()):
+    # Se llama con store.lock tomado, justo después de mutar el store: así el journal queda
+    # en el mismo orden que el store y cada snapshot del publicador coincide con un seq.
+    # Si el journal no se pudo escribir, el store vuelve a como estaba y se devuelve False.
+    try:
+        await journal.registrar(productos, eliminados)
+    except Exception as e:
+        store.revertir()
+        error("journal_fallido", error=str(e))
+        contar("journal_fallos")
+        return False
+    store.confirmar()
+    publicar_cambios(chat_id)
+    return True
+
+def nuevo_id(reservados=()):
+    # Sufijo aleatorio: dos admins (o dos instancias) en el mismo segundo no chocan.
+    while True:
+        pid = f"producto_{int(datetime.now(timezone.utc).timestamp())}_{uuid.uuid4().hex[:8]}"
+        if pid not in store and pid not in reservados:
+            return pid
+
+def nuevo_producto(temp, autor):
+    return Producto(
+        id=temp.get("id") or nuevo_id(),
+        nombre=temp.get("nombre", ""),
+        precio=temp.get("precio", 0),
+        descripcion=temp.get("descripcion", ""),
+        tallas=temp.get("tallas", ""),
+        categoria=temp.get("categoria", "zapatillas"),
+        imagen=temp.get("imagen", ""),
+        imagenes=temp.get("imagenes", []),
+        videos=temp.get("videos", []),
+        derivados=temp.get("derivados", {}),
+        fecha=datetime.now(timezone.utc),
+        agregado_por=autor or "Admin"
+    )
+
 def format_precio(precio):
+    if isinstance(precio, int):
+        return f"{precio:,}"
     try:
         p = float(precio)
         return f"{int(p):,}" if p == int(p) else f"{p:,.2f}"
     except:
         return str(precio)
 
+class SubidorImgBB:
+    # Cliente httpx compartido + semáforo: las fotos se suben en paralelo con un tope de conexiones.
+    def __init__(self, concurrencia=IMGBB_CONCURRENCY, reintentos=IMGBB_RETRIES):
+        self.concurrencia = concurrencia
+        self.reintentos = reintentos
+        self.client = None
+        self.semaforo = None
+        self.pendientes = 0
+
+    def cliente(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_connections=self.concurrencia, max_keepalive_connections=self.concurrencia))
+            self.semaforo = asyncio.Semaphore(self.concurrencia)
+        return self.client
+
+    async def subir(self, file_bytes, filename="img.jpg"):
+        client = self.cliente()
+        img_b64 = base64.b64encode(file_bytes).decode('utf-8')
+        self.pendientes += 1
+        try:
+            async with self.semaforo:
+                for intento in range(self.reintentos):
+                    t = time.perf_counter()
+                    try:
+                        resp = await client.post(IMGBB_API_URL, data={"key": IMGBB_API_KEY, "image": img_b64, "name": filename})
+                        metricas.observar("imgbb_segundos", time.perf_counter() - t, estado=resp.status_code)
+                        if resp.status_code == 200:
+                            data = resp.json()
+                            if data.get("success"):
+                                return data["data"]["display_url"]
+                        elif resp.status_code < 500 and resp.status_code != 429:
+                            error("imgbb_error", estado=resp.status_code)
+                            return None
+                    except Exception as e:
+                        metricas.observar("imgbb_segundos", time.perf_counter() - t, estado="error")
+                        error("imgbb_error", error=str(e), intento=intento + 1)
+                    if intento + 1 < self.reintentos:
+                        await asyncio.sleep(0.5 * 2 ** intento)
+            return None
+        finally:
+            self.pendientes -= 1
+
+    async def cerrar(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+subidor = SubidorImgBB()
+
 async def subir_imagen_imgbb(file_bytes, filename="img.jpg"):
     if not IMGBB_API_KEY:
         return None
+    return await subidor.subir(file_bytes, filename)
+
+def generar_derivados(file_bytes):
+    # Corre en el pool de procesos: devuelve {nombre: bytes WebP} por cada tamaño.
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes))).convert("RGB")
+    derivados = {}
+    for nombre, lado in TAMANOS_DERIVADOS.items():
+        copia = img.copy()
+        copia.thumbnail((lado, lado))
+        buf = io.BytesIO()
+        copia.save(buf, "WEBP", quality=80)
+        derivados[nombre] = buf.getvalue()
+    return derivados
+
+pool_imagenes = None
+
+async def crear_derivados(file_bytes):
+    global pool_imagenes
+    if Image is None or not IMAGE_DERIVATIVES:
+        return {}
+    if pool_imagenes is None:
+        # spawn: hacer fork de un proceso con hilos (asyncio.to_thread, httpx) puede dejar locks tomados en el hijo.
+        pool_imagenes = ProcessPoolExecutor(max_workers=max(1, min(IMGBB_CONCURRENCY, os.cpu_count() or 1)), mp_context=multiprocessing.get_context("spawn"))
     try:
-        img_b64 = base64.b64encode(file_bytes).decode('utf-8')
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post("https://api.imgbb.com/1/upload", data={"key": IMGBB_API_KEY, "image": img_b64, "name": filename})
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success"):
-                    return data["data"]["display_url"]
-        return None
+        with medir("derivados_segundos"):
+            return await asyncio.get_running_loop().run_in_executor(pool_imagenes, generar_derivados, file_bytes)
     except Exception as e:
-        print(f"❌ Error ImgBB: {e}")
+        aviso("derivados_fallidos", error=str(e))
+        return {}
+
+class CacheImagenes:
+    # Fotos ya subidas: "sha:<sha256 de los bytes>" -> {"url", "thumb", "medium"} y
+    # "tg:<file_unique_id>" -> sha, para resolver reenvíos sin descargar nada.
+    # LRU acotado por número de entradas y persistido en disco entre reinicios.
+    def __init__(self, ruta=IMAGE_CACHE_PATH, maximo=IMAGE_CACHE_ENTRIES, espera=IMAGE_CACHE_SAVE_SECONDS):
+        self.ruta = ruta
+        self.maximo = maximo
+        self.espera = espera
+        self.entradas = OrderedDict()
+        self.en_curso = {}
+        self.sucia = False
+        self.tarea = None
+        self.lock = threading.Lock()
+
+    def cargar(self):
+        try:
+            self.entradas = OrderedDict(json.loads(self.ruta.read_text(encoding="utf-8")))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            aviso("cache_imagenes_invalido", error=str(e))
+        return len(self.entradas)
+
+    def escribir(self, entradas):
+        # En un hilo: recibe una copia, el OrderedDict solo se toca desde el loop.
+        contenido = json.dumps(entradas, separators=(",", ":"))
+        with self.lock:
+            self.ruta.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.ruta.with_suffix(".tmp")
+            tmp.write_text(contenido, encoding="utf-8")
+            os.replace(tmp, self.ruta)
+
+    async def guardar(self):
+        self.sucia = False
+        try:
+            await asyncio.to_thread(self.escribir, list(self.entradas.items()))
+        except Exception as e:
+            self.sucia = True
+            aviso("cache_imagenes_no_guardada", error=str(e))
+
+    def programar_guardado(self):
+        self.sucia = True
+        if self.tarea is None or self.tarea.done():
+            self.tarea = asyncio.create_task(self.guardar_luego())
+
+    async def guardar_luego(self):
+        await asyncio.sleep(self.espera)
+        if self.sucia:
+            await self.guardar()
+
+    async def cerrar(self):
+        if self.tarea and not self.tarea.done():
+            self.tarea.cancel()
+            await asyncio.wait([self.tarea])
+        self.tarea = None
+        if self.sucia:
+            await self.guardar()
+
+    def obtener(self, clave):
+        valor = self.entradas.get(clave)
+        if valor is not None:
+            self.entradas.move_to_end(clave)
+        return valor
+
+    def por_telegram(self, file_unique_id):
+        sha = self.obtener(f"tg:{file_unique_id}")
+        return self.obtener(f"sha:{sha}") if sha else None
+
+    def por_contenido(self, sha):
+        return self.obtener(f"sha:{sha}")
+
+    def agregar(self, sha, resultado, file_unique_id=None):
+        self.entradas[f"sha:{sha}"] = resultado
+        self.entradas.move_to_end(f"sha:{sha}")
+        if file_unique_id:
+            self.entradas[f"tg:{file_unique_id}"] = sha
+            self.entradas.move_to_end(f"tg:{file_unique_id}")
+        while len(self.entradas) > self.maximo:
+            self.entradas.popitem(last=False)
+
+cache_imagenes = CacheImagenes()
+
+async def esperar_subida(subida):
+    # Cada usuario espera su propia tarea: cancelar un producto no corta la subida compartida.
+    return await asyncio.shield(subida)
+
+async def subir_foto(photo):
+    # Devuelve {"url": original, "thumb": ..., "medium": ...} o None si falla la original.
+    try:
+        with medir("telegram_segundos", operacion="get_file"):
+            file = await photo.get_file()
+        with medir("telegram_segundos", operacion="descarga"):
+            fbytes = bytes(await file.download_as_bytearray())
+        sha = hashlib.sha256(fbytes).hexdigest()
+        resultado = cache_imagenes.por_contenido(sha)
+        if resultado:
+            # Misma foto con otro file_unique_id (reenviada desde otro chat, p. ej.).
+            contar("cache_imagenes", resultado="sha")
+            cache_imagenes.agregar(sha, resultado, photo.file_unique_id)
+            cache_imagenes.programar_guardado()
+            return resultado
+        contar("cache_imagenes", resultado="fallo")
+        derivados = await crear_derivados(fbytes)
+        urls = await asyncio.gather(subir_imagen_imgbb(fbytes), *[subir_imagen_imgbb(c, f"img_{n}.webp") for n, c in derivados.items()])
+        if not urls[0]:
+            return None
+        resultado = {"url": urls[0], **{n: u for n, u in zip(derivados, urls[1:]) if u}}
+        cache_imagenes.agregar(sha, resultado, photo.file_unique_id)
+        cache_imagenes.programar_guardado()
+        return resultado
+    except Exception as e:
+        error("subida_foto_fallida", error=str(e))
         return None
 
+# ── Espejo de medios ──
+
+def sin_token(texto):
+    return str(texto).replace(BOT_TOKEN, "***") if BOT_TOKEN else str(texto)
+
+def es_de_telegram(url):
+    return bool(url) and url.startswith(TELEGRAM_FILE_URL)
+
+def urls_producto(p):
+    urls = [u for u in [p.get("imagen")] + list(p.get("imagenes") or []) + list(p.get("videos") or []) if u]
+    for d in (p.get("derivados") or {}).values():
+        urls += [u for u in d.values() if isinstance(u, str) and u]
+    return urls
+
+class AlmacenLocal:
+    # Almacén durable de los medios copiados. Otro backend (S3, R2...) solo necesita
+    # url(), existe() y guardar(nombre, archivo) con el archivo ya descargado en disco.
+    nombre = "local"
+
+    def __init__(self, directorio=MEDIA_DIR, url_base=MEDIA_BASE_URL):
+        self.directorio = directorio
+        self.url_base = url_base
+
+    def url(self, nombre):
+        return self.url_base.rstrip("/") + "/" + quote(nombre)
+
+    def ruta(self, nombre):
+        if self.directorio is None:
+            raise ValueError("MEDIA_DIR no configurado")
+        ruta = (self.directorio / nombre).resolve()
+        if not ruta.is_relative_to(self.directorio.resolve()):
+            raise ValueError(f"ruta fuera del almacén: {nombre}")
+        return ruta
+
+    def existe(self, nombre):
+        return self.ruta(nombre).is_file()
+
+    async def guardar(self, nombre, archivo):
+        destino = self.ruta(nombre)
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(shutil.move, archivo, destino)
+        return self.url(nombre)
+
+def crear_almacen():
+    return AlmacenLocal()
+
+almacen = crear_almacen()
+
+async def extraer_poster(video, destino):
+    # Un cuadro de hasta 480px de ancho; si el video dura menos de 1s, el primero.
+    for inicio in ("1", "0"):
+        proc = await asyncio.create_subprocess_exec("ffmpeg", "-v", "error", "-y", "-ss", inicio, "-i", str(video), "-frames:v", "1", "-vf", "scale='min(480,iw)':-2", "-q:v", "5", str(destino),
+                                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.wait_for(proc.wait(), 60)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return False
+        if proc.returncode == 0 and destino.exists() and destino.stat().st_size:
+            return True
+    return False
+
+class EspejoMedios:
+    # Copia en segundo plano los videos de Telegram al almacén: se bajan por trozos a un archivo
+    # temporal (nunca enteros en memoria), se saca un póster con ffmpeg si está instalado y se
+    # reescriben los productos que los usan. También verifica cada tanto todos los medios del catálogo.
+    def __init__(self, concurrencia=MEDIA_CONCURRENCY):
+        self.concurrencia = concurrencia
+        self.client = None
+        self.semaforo = None
+        self.bot = None
+        self.tarea = None
+        self.en_curso = {}
+        # url de Telegram -> file_id (para pedir un link nuevo si caducó) y -> {"url", "poster"} ya copiados.
+        self.archivos = {}
+        self.hechos = {}
+        # url -> estado HTTP o error de la última verificación.
+        self.caidos = {}
+        # /medios: verificación en segundo plano y chats a los que avisar al terminar.
+        self.revision = None
+        self.interesados = set()
+
+    def activo(self):
+        return MEDIA_MIRROR and MEDIA_DIR is not None and bool(almacen.url_base)
+
+    def cliente(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0), follow_redirects=True, limits=httpx.Limits(max_connections=MEDIA_CHECK_CONCURRENCY))
+            self.semaforo = asyncio.Semaphore(self.concurrencia)
+        return self.client
+
+    def encolar(self, url, file_id=None):
+        if not self.activo() or not es_de_telegram(url) or url in self.hechos:
+            return
+        if file_id:
+            self.archivos[url] = file_id
+        if url not in self.en_curso:
+            tarea = self.en_curso[url] = asyncio.create_task(self.copiar(url))
+            tarea.add_done_callback(lambda _: self.en_curso.pop(url, None))
+
+    def recuperar(self, url, file_id):
+        # Copia del espejo caída (p. ej. se perdió el disco): se baja otra vez con el file_id
+        # y, como el nombre sale del contenido, vuelve a quedar en la misma URL.
+        if not self.activo() or url in self.en_curso:
+            return
+        self.hechos.pop(url, None)
+        self.archivos[url] = file_id
+        tarea = self.en_curso[url] = asyncio.create_task(self.copiar(url))
+        tarea.add_done_callback(lambda _: self.en_curso.pop(url, None))
+
+    async def copiar(self, url):
+        self.cliente()
+        async with self.semaforo:
+            try:
+                with medir("espejo_segundos"):
+                    hecho = await self.descargar(url)
+            except Exception as e:
+                contar("espejo", resultado="error")
+                aviso("espejo_fallido", url=sin_token(url), error=sin_token(e))
+                return
+        # El file_id queda en el producto: si la copia se pierde, se vuelve a bajar de Telegram.
+        if self.archivos.get(url):
+            hecho["file_id"] = self.archivos[url]
+        self.hechos[url] = hecho
+        self.archivos.pop(url, None)
+        contar("espejo", resultado="ok")
+        await self.reemplazar(url)
+
+    async def bajar(self, url, destino):
+        enlace = url
+        for intento in range(2):
+            async with self.client.stream("GET", enlace) as resp:
+                if resp.status_code in (401, 403, 404) and intento == 0 and self.archivos.get(url) and self.bot:
+                    # Link caducado: Telegram da uno nuevo a partir del file_id.
+                    enlace = (await self.bot.get_file(self.archivos[url])).file_path
+                    continue
+                resp.raise_for_status()
+                sha = hashlib.sha256()
+                total = 0
+                with open(destino, "wb") as f:
+                    async for trozo in resp.aiter_bytes(1 << 20):
+                        total += len(trozo)
+                        if total > MEDIA_MAX_BYTES:
+                            raise ValueError(f"más de {MEDIA_MAX_BYTES} bytes")
+                        sha.update(trozo)
+                        await asyncio.to_thread(f.write, trozo)
+                return sha.hexdigest()[:32], total
+
+    async def descargar(self, url):
+        temporal = MEDIA_DIR / ".parcial"
+        temporal.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=temporal)
+        os.close(fd)
+        tmp = Path(tmp)
+        tmp_poster = tmp.with_suffix(".jpg")
+        try:
+            sha, total = await self.bajar(url, tmp)
+            # El nombre sale del contenido: el mismo video reenviado no se guarda dos veces.
+            nombre = f"videos/{sha}{Path(urlparse(url).path).suffix.lower() or '.mp4'}"
+            poster = f"videos/{sha}.jpg"
+            hecho = {"url": almacen.url(nombre)}
+            if almacen.existe(poster):
+                hecho["poster"] = almacen.url(poster)
+            elif MEDIA_POSTERS and shutil.which("ffmpeg") and await extraer_poster(tmp, tmp_poster):
+                hecho["poster"] = await almacen.guardar(poster, tmp_poster)
+            if not almacen.existe(nombre):
+                await almacen.guardar(nombre, tmp)
+                contar("bytes_espejados", total)
+            return hecho
+        finally:
+            for f in (tmp, tmp_poster):
+                f.unlink(missing_ok=True)
+
+    def reescribir(self, p):
+        # (videos, derivados) con las copias ya hechas, o None si no hay nada que cambiar.
+        videos = p.get("videos") or []
+        if not any(v in self.hechos for v in videos):
+            return None
+        derivados = dict(p.get("derivados") or {})
+        for v in videos:
+            hecho = self.hechos.get(v)
+            if hecho is None:
+                continue
+            if v != hecho["url"]:
+                derivados.pop(v, None)
+            datos = {k: hecho[k] for k in ("poster", "file_id") if hecho.get(k)}
+            if datos:
+                derivados[hecho["url"]] = datos
+        return [self.hechos[v]["url"] if v in self.hechos else v for v in videos], derivados
+
+    def aplicar(self, p):
+        # Producto nuevo, con store.lock tomado: si la copia terminó antes de guardarlo, ya entra con ella.
+        cambio = self.reescribir(p)
+        if cambio:
+            p["videos"], p["derivados"] = cambio
+        return p
+
+    async def reemplazar(self, url):
+        async with store.lock:
+            cambiados = []
+            for pid, p in list(store.productos.items()):
+                if url in (p.get("videos") or []):
+                    videos, derivados = self.reescribir(p)
+                    if videos != p.get("videos") or derivados != (p.get("derivados") or {}):
+                        cambiados.append(store.actualizar_campos(pid, {"videos": videos, "derivados": derivados}))
+            if cambiados:
+                await confirmar_cambios(None, cambiados)
+        info("espejo_listo", url=self.hechos[url]["url"], poster=bool(self.hechos[url].get("poster")), productos=len(cambiados))
+
+    async def estado(self, url):
+        try:
+            resp = await self.client.head(url)
+            if resp.status_code in (405, 501):
+                # Sin soporte de HEAD: se pide el primer byte.
+                async with self.client.stream("GET", url, headers={"Range": "bytes=0-0"}) as resp:
+                    pass
+            return resp.status_code
+        except Exception as e:
+            return type(e).__name__
+
+    async def verificar(self):
+        self.cliente()
+        urls = {u for p in store.valores() for u in urls_producto(p) if u.startswith(("http://", "https://"))}
+        # De paso, los videos de Telegram que quedaron sin copiar (reinicio, importación...).
+        for u in urls:
+            self.encolar(u)
+        semaforo = asyncio.Semaphore(MEDIA_CHECK_CONCURRENCY)
+
+        async def revisar(u):
+            async with semaforo:
+                return u, await self.estado(u)
+        with medir("verificar_medios_segundos"):
+            resultados = await asyncio.gather(*[revisar(u) for u in urls])
+        self.caidos = {u: e for u, e in resultados if not (isinstance(e, int) and e < 400)}
+        for p in store.valores():
+            derivados = p.get("derivados") or {}
+            for v in p.get("videos") or []:
+                if self.caidos.get(v) in (404, 410) and (derivados.get(v) or {}).get("file_id"):
+                    self.recuperar(v, derivados[v]["file_id"])
+        contar("medios_verificados", len(urls) - len(self.caidos), resultado="ok")
+        contar("medios_verificados", len(self.caidos), resultado="caido")
+        if self.caidos:
+            aviso("medios_caidos", total=len(self.caidos), de=len(urls), ejemplos={sin_token(u): e for u, e in list(self.caidos.items())[:5]})
+        else:
+            info("medios_verificados", total=len(urls))
+        return self.caidos
+
+    async def vigilar(self):
+        await asyncio.sleep(min(60, MEDIA_CHECK_INTERVAL))
+        while True:
+            await publicador.sincronizado.wait()
+            try:
+                await self.verificar()
+            except Exception as e:
+                error("verificacion_medios_fallida", error=str(e))
+            await asyncio.sleep(MEDIA_CHECK_INTERVAL)
+
+    def iniciar(self, app):
+        self.bot = app.bot
+        if MEDIA_CHECK_INTERVAL > 0 and self.tarea is None:
+            self.tarea = asyncio.create_task(self.vigilar())
+
+    async def cerrar(self):
+        # Las copias a medias se retoman en la próxima verificación (si el link sigue vivo).
+        tareas = [t for t in [self.tarea, self.revision] + list(self.en_curso.values()) if t]
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        self.tarea = self.revision = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+espejo = EspejoMedios()
+
+async def obtener_medio(update, context):
+    # Devuelve (url o tarea de subida pendiente, es_video).
+    if update.message.photo:
+        if IMGBB_API_KEY:
+            photo = update.message.photo[-1]
+            resultado = cache_imagenes.por_telegram(photo.file_unique_id)
+            if resultado:
+                contar("cache_imagenes", resultado="telegram")
+                return resultado, False
+            subida = cache_imagenes.en_curso.get(photo.file_unique_id)
+            if subida is None:
+                subida = cache_imagenes.en_curso[photo.file_unique_id] = asyncio.create_task(subir_foto(photo))
+                subida.add_done_callback(lambda _: cache_imagenes.en_curso.pop(photo.file_unique_id, None))
+            else:
+                contar("cache_imagenes", resultado="en_curso")
+            return asyncio.create_task(esperar_subida(subida)), False
+        return "", False
+    if update.message.video:
+        with medir("telegram_segundos", operacion="get_file"):
+            file = await update.message.video.get_file()
+        # El link de Telegram sirve mientras tanto; el espejo lo reemplaza cuando termina la copia.
+        espejo.encolar(file.file_path, file.file_id)
+        return file.file_path, True
+    if update.message.text and update.message.text.startswith("http"):
+        url = update.message.text.strip()
+        return url, any(x in url.lower() for x in ['.mp4', '.mov', '.webm'])
+    return "", False
+
+def primero_del_album(update, context):
+    grupo = update.message.media_group_id
+    if not grupo:
+        return True
+    grupos = context.user_data.setdefault('grupos', set())
+    if grupo in grupos:
+        return False
+    grupos.add(grupo)
+    return True
+
+async def resolver_medios(temp):
+    # Espera solo las subidas que sigan pendientes y descarta las fallidas.
+    async def valor(m):
+        return await m if isinstance(m, asyncio.Task) else m
+    medios = await asyncio.gather(*[valor(m) for m in [temp.get("imagen")] + temp.get("imagenes", [])])
+    urls = []
+    derivados = temp.setdefault("derivados", {})
+    for m in medios:
+        if isinstance(m, dict):
+            if len(m) > 1:
+                derivados[m["url"]] = {k: v for k, v in m.items() if k != "url"}
+            m = m["url"]
+        if m:
+            urls.append(m)
+    temp["imagen"] = urls[0] if urls else ""
+    temp["imagenes"] = urls[1:]
+
+def cancelar_subidas(temp):
+    for m in [temp.get("imagen")] + temp.get("imagenes", []):
+        if isinstance(m, asyncio.Task):
+            m.cancel()
+
 def es_admin(user_id):
     return user_id in ADMIN_IDS
 
 def solo_admins(func):
+    @functools.wraps(func)
     async def wrapper(update, context):
         user = update.effective_user
         if not es_admin(user.id if user else None):
@@ -159,6 +1940,11 @@ async def start(update, context):
         f"📋 /listar - Ver productos\n"
         f"✏️ /editar - Editar\n"
         f"🗑️ /eliminar - Eliminar\n"
+        f"📥 /importar - Importar CSV/JSON\n"
+        f"📤 /exportar - Exportar CSV (/exportar json)\n"
+        f"💲 /precios - Cambiar precios en lote\n"
+        f"📊 /stats - Métricas del bot\n"
+        f"🎬 /medios - Verificar fotos y videos\n"
         f"🌐 /catalogo - Ver URL",
         parse_mode="Markdown"
     )
@@ -168,31 +1954,55 @@ async def catalogo(update, context):
     url = f"https://{GITHUB_USER}.github.io/{GITHUB_REPO}/"
     await update.message.reply_text(f"🌐 *Catálogo:*\n{url}", parse_mode="Markdown")
 
+def texto_listado(pagina, cursor, siguiente, limite=LISTAR_CARACTERES):
+    # Corta antes de pasar el límite de Telegram (4096); devuelve (texto, siguiente cursor o None).
+    texto = ""
+    for i, p in enumerate(pagina, cursor + 1):
+        emoji = "👟" if p.categoria == "zapatillas" else "👕"
+        medios = (1 if p.imagen else 0) + len(p.imagenes) + len(p.videos)
+        linea = f"{i}. {emoji} *{p.nombre[:200]}* - ${format_precio(p.precio)} ({medios} 📷)\n"
+        if texto and len(texto) + len(linea) > limite:
+            return texto, i - 1
+        texto += linea
+    return texto, siguiente
+
+def teclado_siguiente(prefijo, siguiente):
+    return [InlineKeyboardButton("➡️ Siguientes", callback_data=f"{prefijo}{siguiente}")] if siguiente is not None else []
+
 @solo_admins
 async def listar(update, context):
-    if not productos_db:
+    if not store:
         await update.message.reply_text("📭 No hay productos")
         return
-    texto = f"📋 *Productos ({len(productos_db)}):*\n\n"
-    for i, p in enumerate(sorted(productos_db.values(), key=lambda x: x.get("fecha",""), reverse=True), 1):
-        emoji = "👟" if p.get("categoria") == "zapatillas" else "👕"
-        medios = 1 if p.get('imagen') else 0
-        medios += len(p.get('imagenes', [])) + len(p.get('videos', []))
-        texto += f"{i}. {emoji} *{p.get('nombre')}* - ${format_precio(p.get('precio', '0'))} ({medios} 📷)\n"
-        if len(texto) > 3500:
-            await update.message.reply_text(texto, parse_mode="Markdown")
-            texto = ""
-    if texto:
-        await update.message.reply_text(texto, parse_mode="Markdown")
+    pagina, siguiente = store.recientes(0, LISTAR_POR_PAGINA)
+    texto, siguiente = texto_listado(pagina, 0, siguiente)
+    texto = f"📋 *Productos ({len(store)}):*\n\n" + texto
+    boton = teclado_siguiente("lst_", siguiente)
+    await update.message.reply_text(texto, reply_markup=InlineKeyboardMarkup([boton]) if boton else None, parse_mode="Markdown")
+
+async def listar_callback(update, context):
+    query = update.callback_query
+    await query.answer()
+    cursor = int(query.data.replace("lst_", ""))
+    pagina, siguiente = store.recientes(cursor, LISTAR_POR_PAGINA)
+    if not pagina:
+        return
+    texto, siguiente = texto_listado(pagina, cursor, siguiente)
+    boton = teclado_siguiente("lst_", siguiente)
+    await query.message.reply_text(texto, reply_markup=InlineKeyboardMarkup([boton]) if boton else None, parse_mode="Markdown")
+
+def teclado_eliminar(cursor=0):
+    pagina, siguiente = store.recientes(cursor)
+    keyboard = [[InlineKeyboardButton(f"{'👟' if p.get('categoria')=='zapatillas' else '👕'} {p.get('nombre')}", callback_data=f"del_{p.get('id')}")] for p in pagina]
+    keyboard.append(teclado_siguiente("del_pag_", siguiente) + [InlineKeyboardButton("❌ Cancelar", callback_data="del_cancelar")])
+    return InlineKeyboardMarkup(keyboard)
 
 @solo_admins
 async def eliminar_comando(update, context):
-    if not productos_db:
+    if not store:
         await update.message.reply_text("📭 No hay productos")
         return
-    keyboard = [[InlineKeyboardButton(f"{'👟' if p.get('categoria')=='zapatillas' else '👕'} {p.get('nombre')}", callback_data=f"del_{p.get('id')}")] for p in sorted(productos_db.values(), key=lambda x: x.get("fecha",""), reverse=True)[:20]]
-    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="del_cancelar")])
-    await update.message.reply_text("🗑️ *Selecciona:*", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await update.message.reply_text("🗑️ *Selecciona:*", reply_markup=teclado_eliminar(), parse_mode="Markdown")
 
 async def eliminar_callback(update, context):
     query = update.callback_query
@@ -200,28 +2010,39 @@ async def eliminar_callback(update, context):
     if query.data == "del_cancelar":
         await query.edit_message_text("❌ Cancelado")
         return
+    if query.data.startswith("del_pag_"):
+        await query.edit_message_reply_markup(reply_markup=teclado_eliminar(int(query.data.replace("del_pag_", ""))))
+        return
     if query.data.startswith("del_confirm_"):
         pid = query.data.replace("del_confirm_", "")
-        if pid in productos_db:
-            nombre = productos_db[pid].get('nombre')
-            del productos_db[pid]
-            save_and_push_productos()
-            await query.edit_message_text(f"✅ *{nombre}* eliminado", parse_mode="Markdown")
+        # Bajo el lock solo se decide; la respuesta a Telegram va después de soltarlo.
+        async with store.lock:
+            if pid not in store:
+                texto = "❌ El producto ya no existe"
+            else:
+                eliminado = store.eliminar(pid)
+                ok = await confirmar_cambios(update.effective_chat.id, eliminados=[eliminado])
+                texto = f"✅ *{eliminado.get('nombre')}* eliminado" if ok else ERROR_GUARDANDO
+        await query.edit_message_text(texto, parse_mode="Markdown")
         return
     if query.data.startswith("del_"):
         pid = query.data.replace("del_", "")
-        if pid in productos_db:
+        if pid in store:
             keyboard = [[InlineKeyboardButton("✅ Sí", callback_data=f"del_confirm_{pid}")], [InlineKeyboardButton("❌ No", callback_data="del_cancelar")]]
-            await query.edit_message_text(f"⚠️ ¿Eliminar *{productos_db[pid].get('nombre')}*?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await query.edit_message_text(f"⚠️ ¿Eliminar *{store.get(pid).get('nombre')}*?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+
+def teclado_editar(cursor=0):
+    pagina, siguiente = store.recientes(cursor)
+    keyboard = [[InlineKeyboardButton(f"{p.get('nombre')}", callback_data=f"edit_{p.get('id')}")] for p in pagina]
+    keyboard.append(teclado_siguiente("edit_pag_", siguiente) + [InlineKeyboardButton("❌ Cancelar", callback_data="edit_cancelar")])
+    return InlineKeyboardMarkup(keyboard)
 
 @solo_admins
 async def editar_comando(update, context):
-    if not productos_db:
+    if not store:
         await update.message.reply_text("📭 No hay productos")
         return ConversationHandler.END
-    keyboard = [[InlineKeyboardButton(f"{p.get('nombre')}", callback_data=f"edit_{p.get('id')}")] for p in sorted(productos_db.values(), key=lambda x: x.get("fecha",""), reverse=True)[:20]]
-    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="edit_cancelar")])
-    await update.message.reply_text("✏️ *Selecciona:*", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await update.message.reply_text("✏️ *Selecciona:*", reply_markup=teclado_editar(), parse_mode="Markdown")
     return EDITAR_CAMPO
 
 async def editar_seleccionar_campo(update, context):
@@ -230,9 +2051,12 @@ async def editar_seleccionar_campo(update, context):
     if query.data == "edit_cancelar":
         await query.edit_message_text("❌ Cancelado")
         return ConversationHandler.END
+    if query.data.startswith("edit_pag_"):
+        await query.edit_message_reply_markup(reply_markup=teclado_editar(int(query.data.replace("edit_pag_", ""))))
+        return EDITAR_CAMPO
     if query.data.startswith("edit_"):
         pid = query.data.replace("edit_", "")
-        if pid in productos_db:
+        if pid in store:
             context.user_data['edit_producto_id'] = pid
             keyboard = [[InlineKeyboardButton("📝 Nombre", callback_data="ef_nombre")], [InlineKeyboardButton("💰 Precio", callback_data="ef_precio")], [InlineKeyboardButton("📄 Descripción", callback_data="ef_descripcion")], [InlineKeyboardButton("📏 Tallas", callback_data="ef_tallas")], [InlineKeyboardButton("❌ Cancelar", callback_data="edit_cancelar")]]
             await query.edit_message_text("¿Qué editar?", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -254,21 +2078,160 @@ async def editar_guardar_valor(update, context):
     valor = update.message.text.strip()
     pid = context.user_data.get('edit_producto_id')
     campo = context.user_data.get('edit_campo')
-    if pid in productos_db:
+    if pid in store:
         if campo == "precio":
             try:
-                valor = f"{float(valor.replace('$','').replace(',','').replace('.','')):.0f}"
+                valor = parsear_precio(valor)
             except:
                 await update.message.reply_text("❌ Precio inválido")
                 return ConversationHandler.END
-        productos_db[pid][campo] = valor
-        save_and_push_productos()
-        await update.message.reply_text("✅ Actualizado")
+        async with store.lock:
+            if pid not in store:
+                texto = "❌ El producto ya no existe"
+            else:
+                producto = store.actualizar(pid, campo, valor)
+                texto = "✅ Actualizado" if await confirmar_cambios(update.effective_chat.id, [producto]) else ERROR_GUARDANDO
+        await update.message.reply_text(texto)
     context.user_data.clear()
     return ConversationHandler.END
 
+def exportar_csv(productos):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CAMPOS_EXPORTAR, extrasaction="ignore")
+    writer.writeheader()
+    for p in productos:
+        writer.writerow({**p, "imagenes": "|".join(p.get("imagenes", [])), "videos": "|".join(p.get("videos", []))})
+    return buf.getvalue().encode("utf-8-sig")
+
+@solo_admins
+async def exportar(update, context):
+    if context.args and context.args[0].lower() == "json":
+        await update.message.reply_document(document=serializar(store.valores()), filename="productos.json")
+    else:
+        await update.message.reply_document(document=exportar_csv(store.valores()), filename="productos.csv")
+
+def leer_importacion(contenido, nombre_archivo=""):
+    texto = contenido.decode("utf-8-sig").strip()
+    if nombre_archivo.lower().endswith(".json") or texto.startswith("["):
+        filas = json.loads(texto)
+        if not isinstance(filas, list):
+            raise ValueError("el JSON debe ser una lista de productos")
+        return filas
+    return list(csv.DictReader(io.StringIO(texto)))
+
+def validar_importacion(filas, autor):
+    # Valida todas las filas de una pasada; devuelve (productos, errores) sin tocar el store.
+    productos, errores, vistos = [], [], set()
+    for n, fila in enumerate(filas, 1):
+        if not isinstance(fila, dict):
+            errores.append(f"Fila {n}: formato inválido")
+            continue
+        fila = {k.strip().lower(): v for k, v in fila.items() if k}
+        pid = str(fila.get("id") or "").strip()
+        if pid in vistos:
+            errores.append(f"Fila {n}: id {pid} repetido")
+            continue
+        anterior = store.get(pid) if pid else None
+        datos = dict(anterior or {})
+        for campo in ("nombre", "precio", "categoria", "descripcion", "tallas", "imagen"):
+            if campo in fila or not anterior:
+                datos[campo] = str(fila.get(campo) or "").strip()
+        for campo in ("imagenes", "videos"):
+            if campo in fila or not anterior:
+                valor = fila.get(campo) or []
+                datos[campo] = [u.strip() for u in (valor.split("|") if isinstance(valor, str) else valor) if u and u.strip()]
+        datos["categoria"] = (datos.get("categoria") or "zapatillas").lower()
+        if not datos.get("nombre"):
+            errores.append(f"Fila {n}: falta nombre")
+        if datos["categoria"] not in CATEGORIAS:
+            errores.append(f"Fila {n}: categoría '{datos['categoria']}' inválida")
+        if anterior and str(datos.get("precio")).strip() == str(anterior.precio).strip():
+            # Precio sin tocar: se conserva aunque no sea numérico (p. ej. "A consultar" de la
+            # migración); así un /exportar se puede volver a importar tal cual.
+            datos["precio"] = anterior.precio
+        else:
+            try:
+                datos["precio"] = parsear_precio(datos.get("precio"))
+            except ValueError:
+                errores.append(f"Fila {n}: precio inválido")
+        datos["id"] = pid or nuevo_id(vistos)
+        vistos.add(datos["id"])
+        productos.append(Producto.desde(datos) if anterior else nuevo_producto(datos, autor))
+    return productos, errores
+
+@solo_admins
+async def importar_inicio(update, context):
+    await update.message.reply_text("📥 Envía un archivo *CSV* o *JSON* con los productos.\n\nColumnas: " + ", ".join(CAMPOS_EXPORTAR) + "\n(imagenes/videos separados por |, filas con id existente se actualizan)\n\n/cancelar para salir", parse_mode="Markdown")
+    return IMPORTAR_ARCHIVO
+
+async def importar_archivo(update, context):
+    documento = update.message.document
+    try:
+        file = await documento.get_file()
+        filas = leer_importacion(bytes(await file.download_as_bytearray()), documento.file_name or "")
+    except Exception as e:
+        await update.message.reply_text(f"❌ No pude leer el archivo: {e}")
+        return IMPORTAR_ARCHIVO
+    # Todo o nada: se valida y se aplica bajo el lock del store y se publica una sola vez.
+    async with store.lock:
+        productos, errores = validar_importacion(filas, update.effective_user.first_name)
+        if not errores:
+            nuevos = sum(1 for p in productos if p["id"] not in store)
+            for p in productos:
+                store.agregar(p)
+            if not await confirmar_cambios(update.effective_chat.id, productos):
+                errores = [ERROR_GUARDANDO]
+    if errores:
+        resumen = "\n".join(errores[:15]) + (f"\n... y {len(errores) - 15} más" if len(errores) > 15 else "")
+        await update.message.reply_text(f"❌ Importación rechazada, no se aplicó nada:\n\n{resumen}")
+        return ConversationHandler.END
+    await update.message.reply_text(f"✅ Importados {len(productos)} productos ({nuevos} nuevos, {len(productos) - nuevos} actualizados)\n\n🌐 Publicando en catálogo...")
+    return ConversationHandler.END
+
+def calcular_precio(precio, operacion):
+    # En Decimal y con redondeo hacia arriba en la mitad, igual que parsear_precio().
+    actual = precio_decimal(precio or 0)
+    if operacion.startswith("="):
+        return parsear_precio(operacion[1:])
+    if operacion.endswith("%"):
+        nuevo = actual * (1 + Decimal(operacion[:-1].replace(",", ".")) / 100)
+    else:
+        nuevo = actual + parsear_precio(operacion.lstrip("+-")) * (-1 if operacion.startswith("-") else 1)
+    if nuevo < 0:
+        raise ValueError("precio negativo")
+    return int(nuevo.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+@solo_admins
+async def precios_lote(update, context):
+    if len(context.args) != 2:
+        await update.message.reply_text("💲 Uso: /precios <categoría|todos> <cambio>\n\nEj: /precios zapatillas +10%\n/precios ropa -5000\n/precios todos =150000")
+        return
+    categoria, operacion = context.args[0].lower(), context.args[1]
+    async with store.lock:
+        productos = store.valores() if categoria == "todos" else store.de_categoria(categoria)
+        # Un +10% sobre un precio que no es número (quedó así de la migración) no tiene sentido: se salta.
+        omitidos = 0 if operacion.startswith("=") else sum(1 for p in productos if not isinstance(p.precio, int))
+        try:
+            nuevos = [(p["id"], calcular_precio(p.get("precio"), operacion)) for p in productos if operacion.startswith("=") or isinstance(p.precio, int)]
+        except (ValueError, ArithmeticError):
+            nuevos = None
+        if nuevos:
+            actualizados = [store.actualizar(pid, "precio", precio) for pid, precio in nuevos]
+            if not await confirmar_cambios(update.effective_chat.id, actualizados):
+                await update.message.reply_text(ERROR_GUARDANDO)
+                return
+    if not productos:
+        await update.message.reply_text("📭 No hay productos en esa categoría")
+        return
+    if nuevos is None:
+        await update.message.reply_text("❌ Cambio inválido")
+        return
+    aviso_omitidos = f"\n⚠️ {omitidos} sin precio numérico, no se tocaron" if omitidos else ""
+    await update.message.reply_text(f"✅ {len(nuevos)} precios actualizados ({operacion}){aviso_omitidos}\n\n🌐 Publicando en catálogo...")
+
 @solo_admins
 async def agregar_inicio(update, context):
+    cancelar_subidas(context.user_data)
     context.user_data.clear()
     context.user_data['imagenes'] = []
     context.user_data['videos'] = []
@@ -282,8 +2245,7 @@ async def recibir_nombre(update, context):
 
 async def recibir_precio(update, context):
     try:
-        precio = float(update.message.text.strip().replace("$","").replace(",","").replace(".",""))
-        context.user_data['precio'] = f"{precio:.0f}"
+        context.user_data['precio'] = parsear_precio(update.message.text)
     except:
         await update.message.reply_text("❌ Inválido, solo números:")
         return PRECIO
@@ -314,28 +2276,7 @@ async def recibir_imagen(update, context):
     if 'videos' not in context.user_data:
         context.user_data['videos'] = []
     
-    url = ""
-    es_video = False
-    
-    if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        if IMGBB_API_KEY:
-            await update.message.reply_text("📤 Subiendo...")
-            try:
-                fbytes = await file.download_as_bytearray()
-                url = await subir_imagen_imgbb(fbytes)
-                if url:
-                    await update.message.reply_text("✅ Subida")
-            except Exception as e:
-                print(f"Error: {e}")
-    elif update.message.video:
-        file = await update.message.video.get_file()
-        url = file.file_path
-        es_video = True
-        await update.message.reply_text("✅ Video agregado")
-    elif update.message.text and update.message.text.startswith("http"):
-        url = update.message.text.strip()
-        es_video = any(x in url.lower() for x in ['.mp4', '.mov', '.webm'])
+    url, es_video = await obtener_medio(update, context)
     
     if url:
         if es_video:
@@ -345,6 +2286,8 @@ async def recibir_imagen(update, context):
         else:
             context.user_data['imagenes'].append(url)
     
+    if not primero_del_album(update, context):
+        return MAS_MEDIOS
     total = (1 if context.user_data.get('imagen') else 0) + len(context.user_data.get('imagenes', [])) + len(context.user_data.get('videos', []))
     keyboard = [[InlineKeyboardButton("📸 Más fotos", callback_data="mas_fotos")], [InlineKeyboardButton("🎬 Video", callback_data="mas_video")], [InlineKeyboardButton("✅ Finalizar", callback_data="finalizar_medios")]]
     await update.message.reply_text(f"📷 *Medios: {total}*\n\n¿Agregar más?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -360,26 +2303,7 @@ async def procesar_mas_medios(update, context):
     return MAS_MEDIOS
 
 async def recibir_mas_medios(update, context):
-    url = ""
-    es_video = False
-    if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        if IMGBB_API_KEY:
-            await update.message.reply_text("📤 Subiendo...")
-            try:
-                url = await subir_imagen_imgbb(await file.download_as_bytearray())
-                if url:
-                    await update.message.reply_text("✅ Agregada")
-            except:
-                pass
-    elif update.message.video:
-        file = await update.message.video.get_file()
-        url = file.file_path
-        es_video = True
-        await update.message.reply_text("✅ Video agregado")
-    elif update.message.text and update.message.text.startswith("http"):
-        url = update.message.text.strip()
-        es_video = any(x in url.lower() for x in ['.mp4', '.mov', '.webm'])
+    url, es_video = await obtener_medio(update, context)
     
     if url:
         if es_video:
@@ -387,6 +2311,8 @@ async def recibir_mas_medios(update, context):
         else:
             context.user_data.setdefault('imagenes', []).append(url)
     
+    if not primero_del_album(update, context):
+        return MAS_MEDIOS
     total = (1 if context.user_data.get('imagen') else 0) + len(context.user_data.get('imagenes', [])) + len(context.user_data.get('videos', []))
     keyboard = [[InlineKeyboardButton("📸 Más fotos", callback_data="mas_fotos")], [InlineKeyboardButton("🎬 Video", callback_data="mas_video")], [InlineKeyboardButton("✅ Finalizar", callback_data="finalizar_medios")]]
     await update.message.reply_text(f"📷 *Medios: {total}*", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -395,48 +2321,36 @@ async def recibir_mas_medios(update, context):
 async def finalizar_producto_callback(query, context):
     temp = context.user_data
     user = query.from_user
-    producto = {
-        "id": f"producto_{int(datetime.now(timezone.utc).timestamp())}",
-        "nombre": temp.get("nombre", ""),
-        "precio": temp.get("precio", "0"),
-        "descripcion": temp.get("descripcion", ""),
-        "tallas": temp.get("tallas", ""),
-        "categoria": temp.get("categoria", "zapatillas"),
-        "imagen": temp.get("imagen", ""),
-        "imagenes": temp.get("imagenes", []),
-        "videos": temp.get("videos", []),
-        "fecha": datetime.now(timezone.utc).isoformat(),
-        "agregado_por": user.first_name or "Admin"
-    }
-    productos_db[producto["id"]] = producto
-    save_and_push_productos()
+    await resolver_medios(temp)
+    producto = nuevo_producto(temp, user.first_name)
+    async with store.lock:
+        store.agregar(espejo.aplicar(producto))
+        ok = await confirmar_cambios(query.message.chat_id, [producto])
+    if not ok:
+        await query.message.reply_text(ERROR_GUARDANDO)
+        context.user_data.clear()
+        return ConversationHandler.END
     total = (1 if producto['imagen'] else 0) + len(producto['imagenes']) + len(producto['videos'])
     emoji = "👟" if producto['categoria'] == "zapatillas" else "👕"
-    await query.message.reply_text(f"✅ *Producto agregado*\n\n{emoji} *{producto['nombre']}*\n💰 ${format_precio(producto['precio'])}\n📷 {total} medios\n\n🌐 Visible en catálogo", parse_mode="Markdown")
+    await query.message.reply_text(f"✅ *Producto agregado*\n\n{emoji} *{producto['nombre']}*\n💰 ${format_precio(producto['precio'])}\n📷 {total} medios\n\n🌐 Publicando en catálogo...", parse_mode="Markdown")
     context.user_data.clear()
     return ConversationHandler.END
 
 async def finalizar_producto(update, context):
     temp = context.user_data
     user = update.effective_user
-    producto = {
-        "id": f"producto_{int(datetime.now(timezone.utc).timestamp())}",
-        "nombre": temp.get("nombre", ""),
-        "precio": temp.get("precio", "0"),
-        "descripcion": temp.get("descripcion", ""),
-        "tallas": temp.get("tallas", ""),
-        "categoria": temp.get("categoria", "zapatillas"),
-        "imagen": temp.get("imagen", ""),
-        "imagenes": temp.get("imagenes", []),
-        "videos": temp.get("videos", []),
-        "fecha": datetime.now(timezone.utc).isoformat(),
-        "agregado_por": user.first_name or "Admin"
-    }
-    productos_db[producto["id"]] = producto
-    save_and_push_productos()
+    await resolver_medios(temp)
+    producto = nuevo_producto(temp, user.first_name)
+    async with store.lock:
+        store.agregar(espejo.aplicar(producto))
+        ok = await confirmar_cambios(update.effective_chat.id, [producto])
+    if not ok:
+        await update.message.reply_text(ERROR_GUARDANDO)
+        context.user_data.clear()
+        return ConversationHandler.END
     total = (1 if producto['imagen'] else 0) + len(producto['imagenes']) + len(producto['videos'])
     emoji = "👟" if producto['categoria'] == "zapatillas" else "👕"
-    await update.message.reply_text(f"✅ *Producto agregado*\n\n{emoji} *{producto['nombre']}*\n💰 ${format_precio(producto['precio'])}\n📷 {total} medios\n\n🌐 Visible en catálogo", parse_mode="Markdown")
+    await update.message.reply_text(f"✅ *Producto agregado*\n\n{emoji} *{producto['nombre']}*\n💰 ${format_precio(producto['precio'])}\n📷 {total} medios\n\n🌐 Publicando en catálogo...", parse_mode="Markdown")
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -456,28 +2370,175 @@ async def saltar(update, context):
     return await finalizar_producto(update, context)
 
 async def cancelar(update, context):
+    cancelar_subidas(context.user_data)
     context.user_data.clear()
     await update.message.reply_text("❌ Cancelado")
     return ConversationHandler.END
 
-def main():
-    missing = [v for v in ["BOT_TOKEN", "GITHUB_USER", "GITHUB_REPO", "GITHUB_TOKEN", "ADMIN_IDS"] if not os.getenv(v)]
-    if missing:
-        print(f"❌ Faltan: {missing}")
-        return
-    
-    ensure_repo()
-    global productos_db
-    productos_db = {p.get("id", f"p_{i}"): p for i, p in enumerate(load_productos_from_disk())}
-    
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("listar", listar))
-    app.add_handler(CommandHandler("catalogo", catalogo))
-    app.add_handler(CommandHandler("eliminar", eliminar_comando))
-    app.add_handler(CallbackQueryHandler(eliminar_callback, pattern="^del_"))
-    
-    app.add_handler(ConversationHandler(
+@solo_admins
+async def stats(update, context):
+    texto = f"📊 *Métricas*\n\n📦 Productos: {len(store)}\n"
+    texto += "".join(f"• {k}: {v}\n" for k, v in sorted(metricas.valores_medidores().items()))
+    texto += "\n⏱️ *Latencias (p50 / p99)*\n"
+    for nombre, etiquetas, total, p50, p99, _ in metricas.resumen()[:15]:
+        detalle = ",".join(str(v) for k, v in etiquetas.items() if k != "resultado")
+        texto += f"• {nombre}{f' ({detalle})' if detalle else ''}: {p50:g}s / {p99:g}s ×{total}\n"
+    await update.message.reply_text(texto.replace("_", " "), parse_mode="Markdown")
+
+@solo_admins
+async def medios(update, context):
+    # El barrido hace un HEAD por medio: corre en segundo plano y el resultado llega en otro mensaje.
+    espejo.interesados.add(update.effective_chat.id)
+    if espejo.revision is None or espejo.revision.done():
+        espejo.revision = asyncio.create_task(informar_medios(context.bot))
+        await update.message.reply_text("🔎 Verificando medios, te aviso al terminar...")
+    else:
+        await update.message.reply_text("🔎 Ya hay una verificación en curso, te aviso al terminar...")
+
+async def informar_medios(bot):
+    try:
+        caidos = await espejo.verificar()
+    except Exception as e:
+        error("verificacion_medios_fallida", error=str(e))
+        texto = "⚠️ No se pudieron verificar los medios, intenta de nuevo"
+    else:
+        afectados = [p for p in store.valores() if any(u in caidos for u in urls_producto(p))]
+        texto = f"🎬 Medios\n\n⏳ Videos copiándose: {len(espejo.en_curso)}\n❌ Links caídos: {len(caidos)} en {len(afectados)} productos\n"
+        texto += "".join(f"• {p.get('nombre')} ({p.get('id')})\n" for p in afectados[:LISTAR_POR_PAGINA])
+        if len(afectados) > LISTAR_POR_PAGINA:
+            texto += f"... y {len(afectados) - LISTAR_POR_PAGINA} más\n"
+    chats, espejo.interesados = espejo.interesados, set()
+    for chat_id in chats:
+        try:
+            await bot.send_message(chat_id, texto)
+        except Exception as e:
+            aviso("notificacion_fallida", chat=chat_id, error=str(e))
+
+async def fijar_correlacion(update, context):
+    # Grupo -1: corre antes que cualquier handler, en la misma tarea del update.
+    metricas.correlacion.set(getattr(update, "update_id", None) or uuid.uuid4().hex[:8])
+    contar("updates")
+
+def instrumentar_handlers(tg):
+    for handlers in tg.handlers.values():
+        for h in handlers:
+            internos = h.entry_points + [x for estado in h.states.values() for x in estado] + h.fallbacks if isinstance(h, ConversationHandler) else [h]
+            for x in internos:
+                if not isinstance(x, TypeHandler):
+                    x.callback = metricas.instrumentar(x.callback)
+
+def registrar_medidores(app):
+    metricas.medidor("productos", lambda: len(store))
+    metricas.medidor("cambios_pendientes", lambda: publicador.cambios)
+    metricas.medidor("journal_entradas", lambda: len(journal.entradas))
+    metricas.medidor("subidas_pendientes", lambda: subidor.pendientes)
+    metricas.medidor("cache_imagenes_entradas", lambda: len(cache_imagenes.entradas))
+    metricas.medidor("cola_updates", lambda: app.update_queue.qsize())
+    metricas.medidor("sincronizado", lambda: int(publicador.sincronizado.is_set()))
+    metricas.medidor("espejo_pendientes", lambda: len(espejo.en_curso))
+    metricas.medidor("medios_caidos", lambda: len(espejo.caidos))
+
+def es_efimero(ruta):
+    # /tmp se vacía en cada reinicio o redeploy del host.
+    ruta = Path(ruta).resolve()
+    return any(ruta.is_relative_to(Path(d).resolve()) for d in {"/tmp", tempfile.gettempdir()})
+
+async def iniciar_publicador(app):
+    t = time.perf_counter()
+    if es_efimero(JOURNAL_PATH):
+        aviso("journal_efimero", ruta=str(JOURNAL_PATH), detalle="los cambios sin publicar se pierden al reiniciar: configura JOURNAL_PATH en un disco persistente")
+    if espejo.activo() and es_efimero(MEDIA_DIR):
+        aviso("medios_efimeros", ruta=str(MEDIA_DIR), detalle="las copias de videos se pierden al reiniciar: configura MEDIA_DIR en un disco persistente")
+    if es_efimero(SNAPSHOT_PATH):
+        aviso("snapshot_efimero", ruta=str(SNAPSHOT_PATH), detalle="tras un reinicio se arranca esperando al remoto: configura SNAPSHOT_PATH en un disco persistente")
+    productos = await asyncio.to_thread(cargar_snapshot)
+    con_snapshot = productos is not None
+    if not con_snapshot:
+        # Primer arranque sin snapshot: no queda otra que esperar al remoto.
+        productos = await asyncio.to_thread(load_productos_from_disk)
+    store.reemplazar(productos)
+    await asyncio.to_thread(cache_imagenes.cargar)
+    publicador.base = versiones(productos)
+    if con_snapshot:
+        pendientes = journal.reproducir(store)
+        if pendientes:
+            info("journal_recuperado", cambios=pendientes)
+            publicar_cambios()
+    else:
+        # El disco local puede estar vacío (backend API) o atrasado: el journal se reproduce
+        # en sincronizar(), sobre el remoto, y no se publica nada hasta entonces.
+        publicador.journal_pendiente = True
+    TIEMPOS_ARRANQUE["carga"] = time.perf_counter() - t
+    if not con_snapshot:
+        await publicador.sincronizar()
+    publicador.iniciar(app)
+    espejo.iniciar(app)
+    registrar_medidores(app)
+    info("bot_iniciado", backend=backend.nombre, admins=ADMIN_IDS, productos=len(store), arranque={k: round(v, 3) for k, v in TIEMPOS_ARRANQUE.items()})
+
+async def detener_publicador(app):
+    await espejo.cerrar()
+    await publicador.detener(app)
+    await cache_imagenes.cerrar()
+    await backend.cerrar()
+    await subidor.cerrar()
+    if pool_imagenes is not None:
+        pool_imagenes.shutdown(wait=False, cancel_futures=True)
+
+FALTANTES = [v for v in ["BOT_TOKEN", "GITHUB_USER", "GITHUB_REPO", "GITHUB_TOKEN", "ADMIN_IDS"] if not os.getenv(v)]
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    # Updates de distintos usuarios en paralelo, los de un mismo usuario en orden: con
+    # concurrent_updates a secas, dos mensajes seguidos podían pisarse el estado del ConversationHandler.
+    def __init__(self, max_concurrent_updates):
+        # PTB toma su semáforo antes de do_process_update: con el límite ahí, los updates en cola de
+        # un solo usuario ocuparían todos los cupos esperando su lock. El límite real va con el lock tomado.
+        super().__init__(2 ** 16)
+        self.limite = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        usuario = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+        if usuario is None:
+            async with self.limite:
+                await coroutine
+            return
+        entrada = self.locks.setdefault(usuario, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0], self.limite:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                self.locks.pop(usuario, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def construir_aplicacion(con_updater=True, request=None):
+    t = time.perf_counter()
+    builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(ProcesadorPorUsuario(CONCURRENT_UPDATES)).post_init(iniciar_publicador).post_shutdown(detener_publicador)
+    if request is not None:
+        builder = builder.request(request)
+    if not con_updater:
+        builder = builder.updater(None)
+    tg = builder.build()
+    tg.add_handler(CommandHandler("start", start))
+    tg.add_handler(CommandHandler("listar", listar))
+    tg.add_handler(CommandHandler("catalogo", catalogo))
+    tg.add_handler(CommandHandler("eliminar", eliminar_comando))
+    tg.add_handler(CommandHandler("exportar", exportar))
+    tg.add_handler(CommandHandler("precios", precios_lote))
+    tg.add_handler(CommandHandler("stats", stats))
+    tg.add_handler(CommandHandler("medios", medios))
+    tg.add_handler(CallbackQueryHandler(listar_callback, pattern="^lst_"))
+    tg.add_handler(CallbackQueryHandler(eliminar_callback, pattern="^del_"))
+
+    tg.add_handler(ConversationHandler(
         entry_points=[CommandHandler("agregar", agregar_inicio)],
         states={
             NOMBRE: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_nombre)],
@@ -491,8 +2552,8 @@ def main():
         fallbacks=[CommandHandler("cancelar", cancelar)],
         per_message=False
     ))
-    
-    app.add_handler(ConversationHandler(
+
+    tg.add_handler(ConversationHandler(
         entry_points=[CommandHandler("editar", editar_comando)],
         states={
             EDITAR_CAMPO: [CallbackQueryHandler(editar_seleccionar_campo, pattern="^edit_"), CallbackQueryHandler(editar_pedir_valor, pattern="^ef_")],
@@ -501,16 +2562,111 @@ def main():
         fallbacks=[CommandHandler("cancelar", cancelar)],
         per_message=False
     ))
+
+    tg.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("importar", importar_inicio)],
+        states={
+            IMPORTAR_ARCHIVO: [MessageHandler(filters.Document.ALL, importar_archivo)]
+        },
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        per_message=False
+    ))
+    instrumentar_handlers(tg)
+    tg.add_handler(TypeHandler(Update, fijar_correlacion), group=-1)
+    TIEMPOS_ARRANQUE["handlers"] = time.perf_counter() - t
+    return tg
+
+# ── Servidor ASGI (Procfile: uvicorn telegram_bot:app) ──
+# Recibe los webhooks de Telegram, sirve el catálogo desde memoria y corre el publicador
+# dentro del mismo ciclo de vida.
+
+tg_app = None
+
+@contextlib.asynccontextmanager
+async def ciclo_de_vida(asgi):
+    global tg_app
+    if FALTANTES:
+        raise RuntimeError(f"Faltan: {FALTANTES}")
+    tg_app = construir_aplicacion(con_updater=not WEBHOOK_URL)
+    await tg_app.initialize()
+    # initialize()/start() no llaman post_init/post_shutdown (solo run_polling/run_webhook).
+    await iniciar_publicador(tg_app)
+    await tg_app.start()
+    if WEBHOOK_URL:
+        await tg_app.bot.set_webhook(url=f"{WEBHOOK_URL}/{BOT_TOKEN}", secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    else:
+        # Sin URL pública nadie llamaría al webhook: se reciben los updates por polling.
+        aviso("sin_webhook", detalle="WEBHOOK_URL no configurada, usando polling")
+        await tg_app.bot.delete_webhook()
+        await tg_app.updater.start_polling(drop_pending_updates=True)
+    try:
+        yield
+    finally:
+        if tg_app.updater and tg_app.updater.running:
+            await tg_app.updater.stop()
+        await tg_app.stop()
+        await detener_publicador(tg_app)
+        await tg_app.shutdown()
+
+async def webhook(request):
+    if not hmac.compare_digest(request.path_params["token"], BOT_TOKEN or ""):
+        return Response(status_code=404)
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        return Response(status_code=403)
+    await tg_app.update_queue.put(Update.de_json(await request.json(), tg_app.bot))
+    return Response()
+
+async def healthz(request):
+    return JSONResponse({"ok": True, "productos": len(store), "sincronizado": publicador.sincronizado.is_set(), "cambios_pendientes": publicador.cambios})
+
+async def metrics(request):
+    if not METRICS_TOKEN:
+        return Response(status_code=404)
+    autorizacion = request.headers.get("Authorization", "")
+    token = autorizacion[7:] if autorizacion.startswith("Bearer ") else request.query_params.get("token", "")
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return Response(status_code=403)
+    return PlainTextResponse(metricas.prometheus(), media_type="text/plain; version=0.0.4")
+
+cache_catalogo = {"revision": None, "cuerpo": b"", "etag": ""}
+
+async def productos_json(request):
+    if cache_catalogo["revision"] != store.revision:
+        cuerpo = serializar(publicables(store.valores()))
+        cache_catalogo.update(revision=store.revision, cuerpo=cuerpo, etag=f'"{hash_contenido(cuerpo)}"')
+    headers = {"ETag": cache_catalogo["etag"], "Cache-Control": "no-cache", "Access-Control-Allow-Origin": "*"}
+    if request.headers.get("If-None-Match") == cache_catalogo["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(cache_catalogo["cuerpo"], media_type="application/json", headers=headers)
+
+async def medio(request):
+    # Videos y pósters copiados por el espejo; el nombre sale del contenido, nunca cambia.
+    nombre = request.path_params["ruta"]
+    try:
+        ruta = almacen.ruta(nombre)
+    except ValueError:
+        return Response(status_code=404)
+    if nombre.startswith(".") or not ruta.is_file():
+        return Response(status_code=404)
+    return FileResponse(ruta, headers={"Cache-Control": "public, max-age=31536000, immutable", "Access-Control-Allow-Origin": "*"})
+
+app = Starlette(routes=[
+    Route("/healthz", healthz),
+    Route("/metrics", metrics),
+    Route(f"/{JSON_FILENAME}", productos_json),
+    Route("/medios/{ruta:path}", medio),
+    Route("/{token}", webhook, methods=["POST"]),
+], lifespan=ciclo_de_vida)
+
+def main():
+    if FALTANTES:
+        error("configuracion_incompleta", faltan=FALTANTES)
+        return
     
-    print(f"🤖 Bot iniciado | Admins: {ADMIN_IDS} | Productos: {len(productos_db)}")
-    
-    RENDER_URL = os.getenv('RENDER_EXTERNAL_URL')
-    PORT = int(os.getenv('PORT', 10000))
-    
-    if RENDER_URL:
-        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=BOT_TOKEN, webhook_url=f"{RENDER_URL}/{BOT_TOKEN}", drop_pending_updates=True)
+    if WEBHOOK_URL:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
     else:
-        app.run_polling(drop_pending_updates=True)
+        construir_aplicacion().run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()